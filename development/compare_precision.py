@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# compare_precision.py
+
+# Compares the float32 assembly (FiniteBodyForces.precision) with the default float64 assembly on the mesh of
+# example_relax. The nodes on the outer surface are fixed and the forces of bcond.dat are scaled down, so that the
+# deformation stays moderate.
+
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from saenopy import FiniteBodyForces
+from saenopy.materials import SemiAffineFiberMaterial
+from saenopy.loadHelpers import loadBoundaryConditions
+
+folder = os.path.join(os.path.dirname(__file__), "..", "example_relax")
+force_scale = 1e-7
+iterations = 20
+
+
+def loadMesh(precision):
+    M = FiniteBodyForces()
+    M.precision = precision
+    R = np.loadtxt(os.path.join(folder, "coords.dat"))
+    M.setNodes(R)
+    # the tetrahedra are stored with indices starting at 1
+    M.setTetrahedra(np.loadtxt(os.path.join(folder, "tets.dat"), dtype=int) - 1)
+
+    var, U, f = loadBoundaryConditions(os.path.join(folder, "bcond.dat"))
+    outer = np.linalg.norm(R, axis=1) > 0.99 * np.max(np.linalg.norm(R, axis=1))
+    U = np.full(R.shape, np.nan)
+    U[outer] = 0
+    f = f * force_scale
+    f[outer] = np.nan
+    M.setBoundaryCondition(U, f)
+
+    M.setMaterialModel(SemiAffineFiberMaterial(1645, 0.0008, 0.0075, 0.033))
+    M.setBeams(300)
+    return M
+
+
+def relativeDeviation(a, b):
+    return np.linalg.norm(a - b) / np.linalg.norm(b)
+
+
+results = {}
+for precision in [np.float64, np.float32]:
+    M = loadMesh(precision)
+    M.relax(i_max=iterations, rel_conv_crit=1e-11, line_search=True)
+    results[precision] = M
+
+M64 = results[np.float64]
+M32 = results[np.float32]
+U32 = M32.U.copy()
+
+# evaluate both precisions at the same displacements
+M32.setDisplacements(M64.U)
+M32.computeForcesAndStiffness()
+M64.computeForcesAndStiffness()
+
+print("relative deviation of the displacements after %d iterations" % iterations, relativeDeviation(U32, M64.U))
+print("at the same displacements:")
+print("relative deviation of the energy   ", abs(M32.E_glo - M64.E_glo) / abs(M64.E_glo))
+print("relative deviation of the forces   ", relativeDeviation(M32.f[M32.var], M64.f[M64.var]))
+print("relative deviation of the stiffness", relativeDeviation(M32.K_glo.data, M64.K_glo.data))
+
+# the beam moments of the matrix free stiffness
+M32.computeForcesAndStiffness(matrix_free=True)
+M64.computeForcesAndStiffness(matrix_free=True)
+print("memory of the beam moments float64 %.1f MB float32 %.1f MB" % (M64.K_glo.B.nbytes / 1e6,
+                                                                      M32.K_glo.B.nbytes / 1e6))
@@ -5,13 +5,14 @@ import time
 import numpy as np
 import scipy.sparse as ssp
 
-from numba import jit, njit
+from numba import njit, prange, get_num_threads
 from typing import Union
 
-from .multigridHelper import getLinesTetrahedra, getLinesTetrahedra2
-from .buildBeams import buildBeams
+from .multigridHelper import getLinesTetrahedra, getLinesTetrahedra2, getBoxmeshProlongations, \
+    getAggregationProlongations
+from .buildBeams import buildBeams, mergeAntipodalBeams
 from .materials import Material, SemiAffineFiberMaterial
-from .conjugateGradient import cg
+from .conjugateGradient import cg, getPreconditioner, MultigridPreconditioner, SymmetricBlockMatrix
 
 
 class FiniteBodyForces:
@@ -31,6 +32,9 @@ class FiniteBodyForces:
     f = None  # the global forces on each node, dimensions: N_c x 3
     f_target = None  # the external forces on each node, dimensions: N_c x 3
     K_glo = None  # the global stiffness tensor, dimensions: N_c x N_c x 3 x 3
+    # the stiffness of the free degrees of freedom, only its upper half is stored. relax assembles only this part and
+    # does not keep K_glo
+    K_ff = None
 
     Laplace = None
 
@@ -45,9 +49,22 @@ class FiniteBodyForces:
 
     s = None  # the beams, dimensions N_b x 3
     N_b = 0  # the number of beams
+    beam_weights = None  # the weight of each beam in the integral over the body angle, dimensions N_b
 
     material_model = None  # the function specifying the material model
 
+    boxmesh_nx = None  # the number of nodes per axis, if the mesh is a box mesh (see makeBoxmeshCoords)
+
+    assembly_memory = 2 ** 28  # the maximal memory in bytes of the stiffness blocks of the tetrahedra during assembly
+    # the floating point type of the beam moments of the matrix free stiffness and of the stiffness blocks of the
+    # tetrahedra, np.float32 halves their memory. The sums over the tetrahedra, the global stiffness matrix, the forces
+    # and the solvers always use np.float64.
+    precision = np.float64
+    # the stiffness of tetrahedra whose corners moved less than this since their last evaluation is kept (0 for always
+    # re-evaluating all tetrahedra), this keeps 36 beam moments per tetrahedron
+    reassembly_tolerance = 0
+    skipped_tetrahedra = 0  # the number of tetrahedra whose stiffness was kept in the last assembly
+
     def setNodes(self, data: np.ndarray):
         """
         Provide mesh coordinates.
@@ -113,6 +130,9 @@ class FiniteBodyForces:
                 print("WARNING: Forces for non-variable vertices were specified. These boundary conditions cannot be"
                       "fulfilled", file=sys.stderr)
 
+        # the variable nodes may have changed, schedule to recalculate the connections
+        self.connections_valid = False
+
     def setDisplacements(self, displacements: np.ndarray):
         """
         Provide initial displacements of the vertices. For non-variable vertices these displacements stay during the
@@ -204,66 +224,88 @@ class FiniteBodyForces:
         Parameters
         ----------
         material : :py:class:`~.materials.Material`
-             The material, must be of a subclass of Material which implements the method :py:func:`generate_look_up_table`
+             The material, must be of a subclass of Material which implements the method
+             :py:func:`generate_look_up_function`
         """
         self.material_model = material
-        self.material_model_look_up = self.material_model.generate_look_up_table()
+        self.material_model_look_up = self.material_model.generate_look_up_function()
 
-    def setBeams(self, beams: Union[int, np.ndarray] = 300):
+    def setBeams(self, beams: Union[int, np.ndarray] = 300, weights: np.ndarray = None):
         """
-        Sets the beams for the calculation over the whole body angle.
+        Sets the beams for the calculation over the whole body angle. Beams pointing in opposite directions describe the
+        same fiber and are merged into one beam with twice the weight.
 
         Parameters
         ----------
-        beams : int, ndarray
-            Either an integer which defines in how many beams to discretize the whole body angle or an ndarray providing
-            the beams, dimensions Nx3, default 300
+        beams : int, ndarray, tuple
+            Either an integer which defines in how many beams to discretize the whole body angle, an ndarray providing
+            the beams, dimensions Nx3, or a tuple of beams and weights, e.g. of a quadrature rule like
+            :py:func:`~.buildBeams.buildLebedevBeams`, default 300
+        weights : ndarray, optional
+            The weight of each beam, dimensions N. Defaults to uniform weights.
         """
         if isinstance(beams, int):
             beams = buildBeams(beams)
-        self.s = beams
-        self.N_b = beams.shape[0]
+        if isinstance(beams, tuple):
+            beams, weights = beams
+        self.s, self.beam_weights = mergeAntipodalBeams(beams, weights)
+        self.N_b = self.s.shape[0]
 
     def _computeConnections(self):
         # calculate the indices for "update_f_glo"
-        y, x = np.meshgrid(np.arange(3), self.T.ravel())
-        self.force_distribute_coordinates = (x.ravel(), y.ravel())
+        # every entry of the N_T x 4 x 3 force tensor gets the index of its position in the flattened N_c x 3 forces
+        self.force_scatter = (self.T[:, :, None] * 3 + np.arange(3)[None, None, :]).ravel()
 
-        # calculate the indices for "update_K_glo"
-        @njit()
-        def numba_get_pair_coordinates(T, var):
-            stiffness_distribute_coordinates2 = []
-            filter_in = np.zeros((T.shape[0], 4, 4, 3, 3)) == 1
-            # iterate over all tetrahedra
-            for t in range(T.shape[0]):
-                #if t % 1000:
-                #    print(t, T.shape[0])
-                tet = T[t]
-                # over all corners
-                for t1 in range(4):
-                    c1 = tet[t1]
-
-                    if not var[c1]:
-                        continue
-
-                    filter_in[t, t1, :, :, :] = True
-
-                    for t2 in range(4):
-                        # get two vertices of the tetrahedron
-                        c2 = tet[t2]
-
-                        for i in range(3):
-                            for j in range(3):
-                                # add the connection to the set
-                                stiffness_distribute_coordinates2.append((c1*3+i, c2*3+j))
-            stiffness_distribute_coordinates2 = np.array(stiffness_distribute_coordinates2)
-            return filter_in.ravel(), (stiffness_distribute_coordinates2[:, 0], stiffness_distribute_coordinates2[:, 1])
-
-        self.filter_in, self.stiffness_distribute_coordinates2 = numba_get_pair_coordinates(self.T, self.var)
+        # the indices of the degrees of freedom of the variable nodes in the flattened N_c x 3 displacements
+        self.free_dofs = np.where(np.repeat(self.var, 3))[0]
+
+        # the structure of the stiffness matrix is computed when the matrix is assembled for the first time
+        self.stiffness_scatter = None
+        self._prolongations = None
 
         # remember that for the current configuration the connections have been calculated
         self.connections_valid = True
 
+    def _computeStiffnessPattern(self, only_free: bool = False):
+        # calculate the indices for "update_K_glo"
+        # the global stiffness matrix consists of 3x3 blocks K_c1c2 that couple two nodes. Every 3x3 block of the
+        # N_T x 4 x 4 x 3 x 3 stiffness tensor gets the linear index c1 * N_c + c2 of its block in the global stiffness
+        # matrix (or -1 if it belongs to a fixed node)
+        N = self.N_c
+        stiffness_scatter = _get_stiffness_coordinates(self.T, self.var)
+        if only_free:
+            # the part K_ff which couples the free degrees of freedom is symmetric, only the blocks on and above its
+            # diagonal (c1 <= c2) are summed
+            free_entries = self.var[stiffness_scatter % N] & (stiffness_scatter % N >= stiffness_scatter // N)
+            stiffness_scatter[~free_entries] = -1
+        filter_in = stiffness_scatter >= 0
+
+        # the sorted unique blocks define the bsr structure, the inverse maps each block to its slot in the data
+        coordinates, stiffness_scatter[filter_in] = np.unique(stiffness_scatter[filter_in], return_inverse=True)
+        self.stiffness_scatter = stiffness_scatter
+        # the sparsity pattern does not change, later assemblies only overwrite the data
+        blocks = np.zeros((coordinates.shape[0], 3, 3))
+        self._stiffness_only_free = only_free
+
+        if only_free:
+            # K_ff is the only assembled stiffness, its rows and columns are numbered by the free nodes
+            free_index = np.cumsum(self.var) - 1
+            indptr = np.concatenate(([0], np.cumsum(np.bincount(coordinates // N, minlength=N)[self.var])))
+            self.K_ff = SymmetricBlockMatrix(blocks, free_index[coordinates % N], indptr)
+            self.K_glo = None
+        else:
+            indptr = np.concatenate(([0], np.cumsum(np.bincount(coordinates // N, minlength=N))))
+            self.K_glo = ssp.bsr_matrix((blocks, coordinates % N, indptr), shape=(N * 3, N * 3))
+            self.K_glo.has_sorted_indices = True
+            self.K_ff = None
+        # the blocks the tetrahedra are summed into
+        self._stiffness_blocks = blocks
+        # the pattern of K_glo W K_glo for the regularization is computed when it is needed
+        self._kak_pattern = None
+        # the new stiffness has to be assembled from all tetrahedra
+        self._U_T = None
+        self._B_T = None
+
     def _computePhi(self):
         """
         Calculate the shape tensors of the tetrahedra (see page 49)
@@ -300,105 +342,183 @@ class FiniteBodyForces:
         # only count the energy if not the whole tetrahedron is fixed
         self._countEnergy = np.any(self.var[self.T], axis=1)
 
-        # and the shape tensor with the beam
-        # s*_tmb = Phi_tmj * s_jb  (t in [0, N_T], i,j in {x,y,z}, m in {1,2,3,4}), b in [0, N_b])
-        self._s_star = self.Phi @ self.s.T
-
-        self._V_over_Nb = np.expand_dims(self.V, axis=1) / self.N_b
+        # the material, the beams or the mesh may have changed, the next stiffness is assembled from all tetrahedra
+        self._U_T = None
+        self._B_T = None
 
-    def _updateGloFAndK(self):
+    def _evaluateTetrahedra(self, forces: bool = True, stiffness: bool = False, moments: bool = False,
+                            changed: np.ndarray = None):
         """
-        Calculates the stiffness matrix K_ij, the force F_i and the energy E of each node.
+        Evaluates the energy of all tetrahedra in one fused and parallel pass and updates E_glo. The forces f_tmi and the
+        beam moments B_tjkil of the matrix free stiffness are only calculated if they are requested, otherwise the
+        returned arrays are empty.
+
+        If stiffness is True, the stiffness K_tmril is summed into the blocks of K_glo (or of K_ff, see
+        _computeStiffnessPattern). The tetrahedra are then evaluated in batches, whose stiffness blocks fit into
+        assembly_memory, so that the N_T x 4 x 4 x 3 x 3 stiffness tensor is never stored at once. With a
+        reassembly_tolerance, the beam moments of each tetrahedron are kept in _B_T. If changed is given, only the
+        stiffness of these tetrahedra is evaluated and the difference to the stiffness of their kept beam moments is
+        added to the blocks.
         """
-        t_start = time.time()
-        batchsize = 10000
+        def empty_unless(flag, *shape, dtype=np.float64):
+            return np.zeros((self.N_T if flag else 0,) + shape, dtype=dtype)
+
+        f_glo = empty_unless(forces, 4, 3)
+        B = empty_unless(moments, 6, 6, dtype=self.precision)
+        evaluate = np.zeros(0, dtype=bool) if changed is None else changed
+
+        if stiffness:
+            block_size = 4 * 4 * 3 * 3 * np.dtype(self.precision).itemsize
+            batch_size = max(1, min(self.N_T, int(self.assembly_memory) // block_size))
+            K_batch = np.zeros((batch_size, 4, 4, 3, 3), dtype=self.precision)
+            if changed is None:
+                self._stiffness_blocks[:] = 0
+                if self.reassembly_tolerance > 0:
+                    self._B_T = np.zeros((self.N_T, 6, 6), dtype=self.precision)
+        else:
+            batch_size = max(1, self.N_T)
+            K_batch = np.zeros((0, 4, 4, 3, 3), dtype=self.precision)
+
+        for start in range(0, self.N_T, batch_size):
+            t = slice(start, start + batch_size)
+            K = K_batch[:self.T[t].shape[0]]
+            B_t = B[t]
+            if changed is not None:
+                # the stiffness of the changed tetrahedra follows from their new beam moments
+                K = K_batch[:0]
+                B_t = np.zeros((self.T[t].shape[0], 6, 6), dtype=self.precision)
+            elif stiffness and self.reassembly_tolerance > 0:
+                B_t = self._B_T[t]
+            # arrays that are not requested are empty and stay empty when sliced
+            _get_energy_forces_and_stiffness(self.U, self.T[t], self.Phi[t], self.s, self.V[t],
+                                             self.beam_weights, *self.material_model_look_up, self.E[t], f_glo[t], K,
+                                             B_t, evaluate[t])
+            if changed is not None:
+                # K_new - K_old = Phi_mj * Phi_rk * (B_new - B_old)_jkil, without a second sum over the beams
+                tetrahedra = start + np.where(changed[t])[0]
+                K = K_batch[:tetrahedra.shape[0]]
+                _get_stiffness_from_moments(self.Phi[tetrahedra], B_t[tetrahedra - start] - self._B_T[tetrahedra], K)
+                self._B_T[tetrahedra] = B_t[tetrahedra - start]
+                scatter = self.stiffness_scatter.reshape(-1, 16)[tetrahedra].ravel()
+                _scatter_add_blocks(K.reshape(-1, 3, 3), scatter, self._stiffness_blocks)
+            elif stiffness:
+                # transform from batch x 4 x 4 x 3 x 3 -> N_v x N_v x 3 x 3
+                scatter = self.stiffness_scatter[start * 16:(start + K.shape[0]) * 16]
+                _scatter_add_blocks(K.reshape(-1, 3, 3), scatter, self._stiffness_blocks)
 
-        self.E_glo = 0
-        f_glo = np.zeros((self.N_T, 4, 3))
-        K_glo = np.zeros((self.N_T, 4, 4, 3, 3))
+        # only count the energy of the tetrahedron to the global energy if the tetrahedron has at least one
+        # variable node
+        self.E_glo = np.sum(self.E[self._countEnergy])
 
-        for i in range(int(np.ceil(self.T.shape[0]/batchsize))):
-            print("updating forces and stiffness matrix %d%%" % (i/int(np.ceil(self.T.shape[0]/batchsize))*100), end="\r")
-            t = slice(i*batchsize, (i+1)*batchsize)
+        return f_glo, B
 
-            s_bar = self._get_s_bar(t)
+    def _updateGloFAndK(self, matrix_free: bool = False, only_free: bool = False):
+        """
+        Calculates the stiffness matrix K_ij, the force F_i and the energy E of each node.
 
-            epsilon_b, dEdsbar, dEdsbarbar = self._get_applied_epsilon(s_bar, self.material_model_look_up, self._V_over_Nb[t])
+        If matrix_free is True, the stiffness matrix is not assembled. K_glo is then a
+        :py:class:`MatrixFreeStiffness` operator that applies the stiffness from the beam moments of each tetrahedron.
+        If only_free is True, only the upper half of K_ff is assembled and K_glo is not available.
+        """
+        t_start = time.time()
 
-            self._update_energy(epsilon_b, t)
-            self._update_f_glo(self._s_star[t], s_bar, dEdsbar, out=f_glo[t])
-            self._update_K_glo(self._s_star[t], s_bar, dEdsbar, dEdsbarbar, out=K_glo[t])
+        if not matrix_free and (self.stiffness_scatter is None or self._stiffness_only_free != only_free):
+            self._computeStiffnessPattern(only_free)
+
+        # with a reassembly tolerance, the energy and the forces are still evaluated for all tetrahedra, but the
+        # stiffness only for the tetrahedra with a corner that moved more than reassembly_tolerance since the stiffness
+        # of the tetrahedron was last evaluated
+        changed = None
+        if not matrix_free and self.reassembly_tolerance > 0:
+            U_T = self.U[self.T]
+            if self._U_T is None:
+                # remember the corner displacements at which the stiffness of each tetrahedron was evaluated
+                self._U_T = U_T
+                self.skipped_tetrahedra = 0
+            else:
+                changed = np.max(np.linalg.norm(U_T - self._U_T, axis=2), axis=1) > self.reassembly_tolerance
+                self._U_T[changed] = U_T[changed]
+                self.skipped_tetrahedra = self.N_T - np.sum(changed)
+
+        # the stiffness is directly summed into K_glo or K_ff
+        f_glo, B = self._evaluateTetrahedra(stiffness=not matrix_free, moments=matrix_free, changed=changed)
+        if changed is not None:
+            print("re-evaluated the stiffness of %d of %d tetrahedra" % (self.N_T - self.skipped_tetrahedra, self.N_T))
 
         # store the global forces in self.f_glo
         # transform from N_T x 4 x 3 -> N_v x 3
-        ssp.coo_matrix((f_glo.ravel(), self.force_distribute_coordinates), shape=self.f.shape).toarray(out=self.f)
-
-        # store the stiffness matrix K in self.K_glo
-        # transform from N_T x 4 x 4 x 3 x 3 -> N_v * 3 x N_v * 3
-        self.K_glo = ssp.coo_matrix((K_glo.ravel()[self.filter_in], self.stiffness_distribute_coordinates2),
-                                shape=(self.N_c*3, self.N_c*3)).tocsr()
+        _scatter_add(f_glo.ravel(), self.force_scatter, self.f.ravel())
+
+        if matrix_free:
+            # the sparse structure is not needed for the matrix free operator
+            self.stiffness_scatter = None
+            self._U_T = None
+            self._B_T = None
+            self.K_glo = MatrixFreeStiffness(self, B)
+            self.K_ff = MatrixFreeStiffness(self, B, free_only=True)
         print("updating forces and stiffness matrix finished %.2fs" % (time.time() - t_start))
 
-    def _get_s_bar(self, t: np.ndarray):
-        # get the displacements of all corners of the tetrahedron (N_Tx3x4)
-        # u_tim  (t in [0, N_T], i in {x,y,z}, m in {1,2,3,4})
-        # F is the linear map from T (the undeformed tetrahedron) to T' (the deformed tetrahedron)
-        # F_tij = d_ij + u_tmi * Phi_tmj  (t in [0, N_T], i,j in {x,y,z}, m in {1,2,3,4})
-        F = np.eye(3) + np.einsum("tmi,tmj->tij", self.U[self.T[t]], self.Phi[t])
-
-        # multiply the F tensor with the beam
-        # s'_tib = F_tij * s_jb  (t in [0, N_T], i,j in {x,y,z}, b in [0, N_b])
-        s_bar = F @ self.s.T
-
-        return s_bar
+    def _updateGloF(self):
+        """
+        Calculates the force F_i of each node and the energy E, without the stiffness.
+        """
+        f_glo = self._evaluateTetrahedra()[0]
+        _scatter_add(f_glo.ravel(), self.force_scatter, self.f.ravel())
 
-    @staticmethod
-    @jit(nopython=True, cache=True)
-    def _get_applied_epsilon(s_bar: np.ndarray, lookUpEpsilon: callable, _V_over_Nb: np.ndarray):
-        # the "deformation" amount # p 54 equ 2 part in the parentheses
-        # s_tb = |s'_tib|  (t in [0, N_T], i in {x,y,z}, b in [0, N_b])
-        s = np.linalg.norm(s_bar, axis=1)
+    def _updateGloE(self):
+        """
+        Calculates only the energy E of each tetrahedron and the global energy E_glo, without forces and stiffness.
+        """
+        self._evaluateTetrahedra(forces=False)
 
-        epsilon_b, epsbar_b, epsbarbar_b = lookUpEpsilon(s - 1)
+    def computeEnergy(self) -> float:
+        """
+        Calculates the energy of the current displacements. Forces and stiffness are not calculated.
 
-        #                eps'_tb    1
-        # dEdsbar_tb = - ------- * --- * V_t
-        #                 s_tb     N_b
-        dEdsbar = - (epsbar_b / s) * _V_over_Nb
+        Returns
+        -------
+        E_glo : float
+            The energy of all tetrahedra with at least one variable node.
+        """
+        self._check_relax_ready()
+        self._prepare_temporary_quantities()
+        self._updateGloE()
+        return self.E_glo
 
-        #                  s_tb * eps''_tb - eps'_tb     1
-        # dEdsbarbar_tb = --------------------------- * --- * V_t
-        #                         s_tb**3               N_b
-        dEdsbarbar = ((s * epsbarbar_b - epsbar_b) / (s ** 3)) * _V_over_Nb
+    def computeForces(self) -> np.ndarray:
+        """
+        Calculates the forces (and the energy) of the current displacements, without assembling the stiffness matrix.
 
-        return epsilon_b, dEdsbar, dEdsbarbar
+        Returns
+        -------
+        f : ndarray
+            The forces on the nodes, dimensions N_c x 3.
+        """
+        self._check_relax_ready()
+        self._prepare_temporary_quantities()
+        self._updateGloF()
+        return self.f
 
-    def _update_energy(self, epsilon_b: np.ndarray, t: np.ndarray):
-        # sum the energy of this tetrahedron
-        # E_t = eps_tb * V_t
-        self.E[t] = np.mean(epsilon_b, axis=1) * self.V[t]
+    def computeForcesAndStiffness(self, matrix_free: bool = False) -> (np.ndarray, ssp.bsr_matrix):
+        """
+        Calculates the forces, the energy and the stiffness matrix of the current displacements.
 
-        # only count the energy of the tetrahedron to the global energy if the tetrahedron has at least one
-        # variable node
-        self.E_glo += np.sum(self.E[t][self._countEnergy[t]])
-
-    def _update_f_glo(self, s_star: np.ndarray, s_bar: np.ndarray, dEdsbar: np.ndarray, out: np.ndarray):
-        # f_tmi = s*_tmb * s'_tib * dEds'_tb  (t in [0, N_T], i in {x,y,z}, m in {1,2,3,4}, b in [0, N_b])
-        np.einsum("tmb,tib,tb->tmi", s_star, s_bar, dEdsbar, out=out)
-
-    def _update_K_glo(self, s_star: np.ndarray, s_bar: np.ndarray, dEdsbar: np.ndarray, dEdsbarbar: np.ndarray, out: np.ndarray):
-        #                              / |  |     \      / |  |     \                   / |    |     \
-        #     ___             /  s'  w"| |s'| - 1 | - w' | |s'| - 1 |                w' | | s' | - 1 |             \
-        # 1   \   *     *     |   b    \ | b|     /      \ | b|     /                   \ |  b |     /             |
-        # -    > s   * s    * | ------------------------------------ * s' * s'  + ---------------------- * delta   |
-        # N   /   bm    br    |                  |s'|³                  ib   lb             |s'  |              li |
-        #  b  ---             \                  | b|                                       |  b |                 /
-        #
-        # (t in [0, N_T], i,l in {x,y,z}, m,r in {1,2,3,4}, b in [0, N_b])
-        s_bar_s_bar = 0.5 * (np.einsum("tb,tib,tlb->tilb", dEdsbarbar, s_bar, s_bar)
-                             - np.einsum("il,tb->tilb", np.eye(3), dEdsbar))
-
-        np.einsum("tmb,trb,tilb->tmril", s_star, s_star, s_bar_s_bar, out=out, optimize=['einsum_path', (0, 1), (0, 1)])
+        Parameters
+        ----------
+        matrix_free : bool, optional
+            If True, the stiffness is returned as :py:class:`MatrixFreeStiffness` operator instead of a sparse matrix.
+
+        Returns
+        -------
+        f : ndarray
+            The forces on the nodes, dimensions N_c x 3.
+        K_glo : sparse matrix
+            The stiffness matrix, dimensions 3N_c x 3N_c.
+        """
+        self._check_relax_ready()
+        self._prepare_temporary_quantities()
+        self._updateGloFAndK(matrix_free)
+        return self.f, self.K_glo
 
     def _check_relax_ready(self):
         """
@@ -428,7 +548,9 @@ class FiniteBodyForces:
         if self.connections_valid is False:
             self._computeConnections()
 
-    def relax(self, stepper: float = 0.066, i_max: int = 300, rel_conv_crit: float = 0.01, relrecname: str = None):
+    def relax(self, stepper: float = 0.066, i_max: int = 300, rel_conv_crit: float = 0.01, relrecname: str = None,
+              matrix_free: bool = False, preconditioner: str = None, warm_start: bool = False,
+              adaptive_tolerance: bool = False, line_search: bool = False):
         """
         Calculate the displacement of the nodes for the given external forces.
 
@@ -444,32 +566,73 @@ class FiniteBodyForces:
         relrecname : string, optional
             If a filename is provided, for every iteration the displacement of the conjugate gradient step, the global
             energy and the residuum are stored in this file.
+        matrix_free : bool, optional
+            If True, the global stiffness matrix is not assembled. The conjugate gradient applies the stiffness
+            tetrahedron by tetrahedron from its beam moments instead, which needs less memory but more
+            computation time for every iteration. Default False
+        preconditioner : string, optional
+            The preconditioner for the conjugate gradient: None, "jacobi", "block_jacobi", "multigrid" or "amg". The
+            geometric "multigrid" needs a box mesh (see boxmesh_nx), both multigrid variants need an assembled
+            matrix. Default None
+        warm_start : bool, optional
+            If True, the conjugate gradient starts from the part of the previous solution which has not been applied.
+            As the full Newton step is half the solution, applying the step alpha leaves (1 - 2 alpha) of it, with the
+            step length of the line search or stepper. Default False
+        adaptive_tolerance : bool, optional
+            If True, the tolerance of the conjugate gradient follows the decrease of the residuum (Eisenstat-Walker),
+            loose for the first iterations and tightening down to the default tolerance. Default False
+        line_search : bool, optional
+            If True, the step length along the conjugate gradient solution is chosen by a backtracking line search on
+            the total energy, starting from the full Newton step. If no step decreases the energy sufficiently, the
+            step of length stepper is applied. Default False
         """
 
         # check if everything is prepared
         self._check_relax_ready()
+        if matrix_free and preconditioner in ["multigrid", "amg"]:
+            raise ValueError("The %s preconditioner needs an assembled stiffness matrix, it cannot be used with "
+                             "matrix_free." % preconditioner)
 
         self._prepare_temporary_quantities()
 
-        # update the forces and stiffness matrix
-        self._updateGloFAndK()
+        # update the forces and stiffness matrix, the conjugate gradient only needs K_ff
+        self._updateGloFAndK(matrix_free, only_free=True)
 
         relrec = [[0, self.E_glo, np.sum(self.f[self.var] ** 2)]]
 
+        # the relative residuum eta of the conjugate gradient, its tolerance is eta**2 as it compares squared norms
+        tol = 0.00001
+        eta = 0.5
+        ff = np.sum((self.f[self.var] - self.f_target[self.var]) ** 2)
+        uu = None
+
         start = time.time()
         # start the iteration
         for i in range(i_max):
+            # the previous solution has only been applied partially, the rest is a good guess for the next solution
+            x0 = max(1 - 2 * step, 0) * uu if warm_start and uu is not None else None
+
             # move the displacements in the direction of the forces one step
             # but while moving the stiffness tensor is kept constant
-            du = self._solve_CG(stepper)
+            du, uu, step = self._solve_CG(stepper, preconditioner, tol=eta ** 2 if adaptive_tolerance else tol, x0=x0,
+                                          line_search=line_search)
 
             # update the forces on each tetrahedron and the global stiffness tensor
-            self._updateGloFAndK()
+            self._updateGloFAndK(matrix_free, only_free=True)
 
             # sum all squared forces of non fixed nodes
+            ff_old = ff
             ff = np.sum((self.f[self.var] - self.f_target[self.var]) ** 2)
             #ff = np.sum(self.f[self.var] ** 2)
 
+            # Eisenstat-Walker (choice 2, gamma=0.9, alpha=2): eta = gamma * (|r_new| / |r_old|)**alpha
+            eta_safeguard = 0.9 * eta ** 2
+            eta = 0.9 * ff / ff_old
+            # do not tighten too quickly and stay between the default tolerance and 0.9
+            if eta_safeguard > 0.1:
+                eta = max(eta, eta_safeguard)
+            eta = min(max(eta, np.sqrt(tol)), 0.9)
+
             # print and store status
             print("Newton ", i, ": du=", du, "  Energy=", self.E_glo, "  Residuum=", ff)
 
@@ -478,42 +641,214 @@ class FiniteBodyForces:
             if relrecname is not None:
                 np.savetxt(relrecname, relrec)
 
-            # if we have passed 6 iterations calculate average and std
-            if i > 6:
-                # calculate the average energy over the last 6 iterations
-                last_Es = np.array(relrec)[:-6:-1, 1]
-                Emean = np.mean(last_Es)
-                Estd = np.std(last_Es)/np.sqrt(5)  # the original formula just had /N instead of /sqrt(N)
+            # if the iterations converge, stop the iteration
+            if self._isConverged(relrec, rel_conv_crit):
+                break
 
-                # if the iterations converge, stop the iteration
-                if Estd / Emean < rel_conv_crit:
+        # print the elapsed time
+        finish = time.time()
+        print("| time for relaxation was", finish - start)
+
+    @staticmethod
+    def _isConverged(relrec: list, rel_conv_crit: float) -> bool:
+        """
+        Whether the relative standard deviation of the last energies in the relaxation record is below rel_conv_crit.
+        """
+        # if we have passed 6 iterations calculate average and std
+        if len(relrec) > 8:
+            # calculate the average energy over the last 6 iterations
+            last_Es = np.array(relrec)[:-6:-1, 1]
+            Emean = np.mean(last_Es)
+            Estd = np.std(last_Es)/np.sqrt(5)  # the original formula just had /N instead of /sqrt(N)
+
+            return Estd / Emean < rel_conv_crit
+        return False
+
+    def relaxLBFGS(self, i_max: int = 3000, rel_conv_crit: float = 0.01, relrecname: str = None, history: int = 10):
+        """
+        Calculate the displacement of the nodes for the given external forces by minimizing the total energy
+        E_glo + f_target * U with the limited memory BFGS method. Only energies and forces are evaluated, the stiffness
+        matrix is never assembled, so the memory grows only linearly with the mesh size. It needs more iterations than
+        :py:meth:`~.FiniteBodyForces.relax`, but each iteration is cheaper.
+
+        Parameters
+        ----------
+        i_max : int, optional
+            The maximal number of iterations. Default 3000
+        rel_conv_crit : float, optional
+            If the relative standard deviation of the last 6 energy values is below this threshold, finish the iteration.
+            Default 0.01
+        relrecname : string, optional
+            If a filename is provided, for every iteration the squared length of the step, the global energy and the
+            residuum are stored in this file.
+        history : int, optional
+            The number of previous steps used to approximate the inverse Hessian. Default 10
+        """
+        # check if everything is prepared
+        self._check_relax_ready()
+
+        self._prepare_temporary_quantities()
+
+        f_target = self.f_target[self.var].ravel()
+
+        def getTotalEnergyAndGradient():
+            self._updateGloF()
+            return self.E_glo + np.sum(f_target * self.U[self.var].ravel()), \
+                   -(self.f[self.var] - self.f_target[self.var]).ravel()
+
+        energy, gradient = getTotalEnergyAndGradient()
+
+        relrec = [[0, self.E_glo, np.sum(self.f[self.var] ** 2)]]
+
+        # the previous steps s and the change of the gradient y
+        steps = []
+
+        start = time.time()
+        # start the iteration
+        for i in range(i_max):
+            # the two loop recursion approximates the inverse Hessian times the gradient
+            direction = -gradient
+            alphas = []
+            for s_k, y_k in steps[::-1]:
+                a = np.sum(s_k * direction) / np.sum(y_k * s_k)
+                direction -= a * y_k
+                alphas.append(a)
+            if len(steps):
+                s_k, y_k = steps[-1]
+                direction *= np.sum(s_k * y_k) / np.sum(y_k * y_k)
+            for (s_k, y_k), a in zip(steps, alphas[::-1]):
+                direction += (a - np.sum(y_k * direction) / np.sum(y_k * s_k)) * s_k
+
+            # backtracking line search (Armijo), without history the step length is unknown and may need more halvings
+            U = self.U[self.var].copy()
+            slope = np.sum(gradient * direction)
+            alpha = 1
+            for j in range(20 if len(steps) else 60):
+                self.U[self.var] = U + alpha * direction.reshape(-1, 3)
+                new_energy, new_gradient = getTotalEnergyAndGradient()
+                if new_energy <= energy + 1e-4 * alpha * slope:
                     break
+                alpha *= 0.5
+            else:
+                # no decrease found, restore the displacements and stop
+                self.U[self.var] = U
+                self._updateGloF()
+                print("L-BFGS: line search failed", file=sys.stderr)
+                break
+
+            # remember the step and the change of the gradient, if the curvature is positive
+            s_k = alpha * direction
+            y_k = new_gradient - gradient
+            if np.sum(s_k * y_k) > 0:
+                steps.append((s_k, y_k))
+                if len(steps) > history:
+                    steps.pop(0)
+            energy, gradient = new_energy, new_gradient
+
+            du = np.sum(s_k ** 2)
+            ff = np.sum(gradient ** 2)
+
+            # print and store status
+            print("L-BFGS ", i, ": du=", du, "  Energy=", self.E_glo, "  Residuum=", ff)
+
+            # log and store values (if a target file was provided)
+            relrec.append([du, self.E_glo, ff])
+            if relrecname is not None:
+                np.savetxt(relrecname, relrec)
+
+            # if the iterations converge, stop the iteration
+            if self._isConverged(relrec, rel_conv_crit):
+                break
 
         # print the elapsed time
         finish = time.time()
         print("| time for relaxation was", finish - start)
 
-    def _solve_CG(self, stepper: float):
+    def _solve_CG(self, stepper: float, preconditioner: str = None, tol: float = 0.00001, x0: np.ndarray = None,
+                  line_search: bool = False):
         """
         Solve the displacements from the current stiffness tensor using conjugate gradient.
         """
         # calculate the difference between the current forces on the nodes and the desired forces
-        ff = self.f - self.f_target
-
-        # ignore the force deviations on fixed nodes
-        ff[~self.var, :] = 0
+        # only for the free degrees of freedom, the fixed nodes do not move
+        ff = (self.f - self.f_target).ravel()[self.free_dofs]
 
         # solve the conjugate gradient which solves the equation A x = b for x
-        # where A is the stiffness matrix K_glo and b is the vector of the target forces
-        uu = cg(self.K_glo, ff.ravel(), maxiter=3 * self.N_c, tol=0.00001).reshape(ff.shape)
+        # where A is the stiffness matrix K_ff of the free degrees of freedom and b is the vector of the target forces
+        uu = cg(self.K_ff, ff, maxiter=3 * self.N_c, tol=tol,
+                M=self._getPreconditioner(preconditioner, self.K_ff, free_only=True), x0=x0)
+
+        if line_search:
+            stepper = self._lineSearch(uu, ff, stepper)
 
         # add the new displacements to the stored displacements
-        self.U[self.var] += uu[self.var] * stepper
+        self.U[self.var] += uu.reshape(-1, 3) * stepper
         # sum the applied displacements
-        du = np.sum(uu[self.var] ** 2) * stepper * stepper
+        du = np.sum(uu ** 2) * stepper * stepper
 
-        # return the total applied displacement
-        return du
+        # return the total applied displacement, the solution of the conjugate gradient and the applied step length
+        return du, uu, stepper
+
+    def _lineSearch(self, uu: np.ndarray, ff: np.ndarray, stepper: float) -> float:
+        """
+        Backtracking line search along the conjugate gradient solution uu for the total energy E_glo + f_target * U of
+        the free nodes. As K_glo is half the Hessian of the energy, the full Newton step is 0.5 * uu. Returns the first
+        step that fulfills the Armijo condition, or stepper if there is none.
+        """
+        U = self.U.copy()
+        f_target = self.f_target[self.var].ravel()
+
+        def getTotalEnergy(alpha):
+            self.U[self.var] = U[self.var] + alpha * uu.reshape(-1, 3)
+            self._updateGloE()
+            return self.E_glo + np.sum(f_target * self.U[self.var].ravel())
+
+        # the gradient of the total energy is -ff, i.e. the derivative along uu is -ff * uu
+        total_energy = self.E_glo + np.sum(f_target * U[self.var].ravel())
+        slope = -np.sum(ff * uu)
+
+        alpha = 0.5
+        if slope < 0:
+            for i in range(10):
+                if getTotalEnergy(alpha) <= total_energy + 1e-4 * alpha * slope:
+                    break
+                alpha *= 0.5
+            else:
+                alpha = stepper
+        else:
+            alpha = stepper
+
+        # restore the displacements, the step is applied by the caller
+        self.U[:] = U
+        return alpha
+
+    def _getPreconditioner(self, preconditioner: str, A, free_only: bool = False):
+        """
+        Create the preconditioner for the conjugate gradient of the matrix A, which either acts on all degrees of
+        freedom or only on the free ones (free_only).
+        """
+        if preconditioner == "multigrid" or preconditioner == "amg":
+            free = None if free_only else np.repeat(self.var, 3)
+            if not (ssp.issparse(A) or isinstance(A, SymmetricBlockMatrix)):
+                raise ValueError("Multigrid preconditioning needs an assembled sparse matrix.")
+            # the multigrid hierarchy needs the matrix with all its scalar rows
+            A = A.tocsr() if isinstance(A, SymmetricBlockMatrix) else ssp.csr_matrix(A)
+            # the grid hierarchy is reused as long as the mesh and the sparsity pattern do not change
+            if self._prolongations is None or self._prolongations[0] != preconditioner or \
+                    not np.array_equal(self._prolongations[1], A.indptr) or \
+                    not np.array_equal(self._prolongations[2], A.indices):
+                if preconditioner == "multigrid":
+                    if self.boxmesh_nx is None:
+                        raise ValueError("Multigrid preconditioning needs a box mesh, boxmesh_nx is not set.")
+                    # expand the node prolongations to the 3 degrees of freedom of each node
+                    prolongations = [ssp.kron(P, np.eye(3)).tocsr() for P in getBoxmeshProlongations(self.boxmesh_nx)]
+                    if free_only:
+                        prolongations[0] = prolongations[0][self.free_dofs]
+                else:
+                    prolongations = getAggregationProlongations(A, free)
+                self._prolongations = (preconditioner, A.indptr.copy(), A.indices.copy(), prolongations)
+            return MultigridPreconditioner(A, self._prolongations[3], free)
+        return getPreconditioner(preconditioner, A)
 
     """ regularization """
 
@@ -573,16 +908,39 @@ class FiniteBodyForces:
 
         print("total weight: ", counter, "/", counterall)
 
-    def _computeRegularizationAAndb(self, alpha: float):
-        KA = self.K_glo.multiply(np.repeat(self.localweight * alpha, 3)[None, :])
-        self.KAK = KA @ self.K_glo
-        self.A = self.I + self.KAK
+    def _computeRegularizationAAndb(self, alpha: float, explicit_kak: bool = False):
+        weights = np.repeat(self.localweight * alpha, 3)
+        if explicit_kak:
+            self.KAK = self._computeKAK(weights)
+            self.A = self.I + self.KAK
+        else:
+            # apply A = I + K W K as operator, the product K W K is never formed
+            self.A = RegularizationOperator(self.K_glo, weights, self.I.diagonal())
 
-        self.b = (KA @ self.f.ravel()).reshape(self.f.shape)
+        self.b = (self.K_glo @ (weights * self.f.ravel())).reshape(self.f.shape)
 
         index = self.var & self.U_target_mask
         self.b[index] += self.U_target[index] - self.U[index]
 
+    def _computeKAK(self, weights: np.ndarray) -> ssp.bsr_matrix:
+        """
+        The product K_glo W K_glo with the diagonal weights W. The block sparsity pattern only depends on the pattern
+        of K_glo and is computed once, every further product only computes the values.
+        """
+        K = self.K_glo
+        if self._kak_pattern is None:
+            N = K.shape[0] // 3
+            pattern = ssp.csr_matrix((np.ones(K.indices.shape[0]), K.indices, K.indptr), shape=(N, N))
+            product = (pattern @ pattern).tocsr()
+            product.sort_indices()
+            self._kak_pattern = (product.indptr, product.indices, np.zeros((product.indices.shape[0], 3, 3)))
+        indptr, indices, data = self._kak_pattern
+
+        _get_weighted_product(K.indptr, K.indices, K.data, weights, indptr, indices, data)
+        KAK = ssp.bsr_matrix((data, indices, indptr), shape=K.shape)
+        KAK.has_sorted_indices = True
+        return KAK
+
     def _recordRegularizationStatus(self, relrec: list, alpha: float, relrecname: str = None):
         indices = self.var & self.U_target_mask
         btemp = self.U_target[indices] - self.U[indices]
@@ -609,7 +967,8 @@ class FiniteBodyForces:
             np.savetxt(relrecname, relrec)
 
     def regularize(self, stepper: float =0.33, solver_precision: float =1e-18, i_max: int = 100,
-                   rel_conv_crit: float = 0.01, alpha: float = 3e9, method: str = "huber", relrecname: str = None):
+                   rel_conv_crit: float = 0.01, alpha: float = 3e9, method: str = "huber", relrecname: str = None,
+                   preconditioner: str = None, explicit_kak: bool = False):
         """
         Fit the provided displacements. Displacements can be provided with
         :py:meth:`~.FiniteBodyForces.setFoundDisplacements`.
@@ -636,6 +995,12 @@ class FiniteBodyForces:
                 "singlepoint"
         relrecname : string, optional
             The file where to store the output. Default is to not store the output, just to return it.
+        preconditioner : string, optional
+            The preconditioner for the conjugate gradient: None, "jacobi", "block_jacobi", "multigrid" or "amg".
+            Default None
+        explicit_kak : bool, optional
+            If True, the matrix I + K W K of the conjugate gradient is assembled as sparse matrix, otherwise it is
+            applied as operator. The multigrid preconditioners always use the assembled matrix. Default False
         """
         self.I = ssp.lil_matrix((self.U_target_mask.shape[0] * 3, self.U_target_mask.shape[0] * 3))
         self.I.setdiag(np.repeat(self.U_target_mask, 3))
@@ -663,10 +1028,10 @@ class FiniteBodyForces:
                 self._updateLocalRegularizationWeigth(method)
 
             # compute A and b for the linear equation that solves the regularisation problem
-            self._computeRegularizationAAndb(alpha)
+            self._computeRegularizationAAndb(alpha, explicit_kak or preconditioner in ["multigrid", "amg"])
 
             # get and apply the displacements that solve the regularisation term
-            uu = self._solve_regularization_CG(stepper, solver_precision)
+            uu = self._solve_regularization_CG(stepper, solver_precision, preconditioner)
 
             # update the forces on each tetrahedron and the global stiffness tensor
             self._updateGloFAndK()
@@ -689,14 +1054,16 @@ class FiniteBodyForces:
 
         return relrec
 
-    def _solve_regularization_CG(self, stepper: float =0.33, solver_precision: float = 1e-18):
+    def _solve_regularization_CG(self, stepper: float =0.33, solver_precision: float = 1e-18,
+                                 preconditioner: str = None):
         """
         Solve the displacements from the current stiffness tensor using conjugate gradient.
         """
 
         # solve the conjugate gradient which solves the equation A x = b for x
         # where A is (I - KAK) (K: stiffness matrix, A: weight matrix) and b is (u_meas - u - KAf)
-        uu = cg(self.A, self.b.flatten(), maxiter=25*int(pow(self.N_c, 0.33333)+0.5), tol=self.N_c * solver_precision).reshape((self.N_c, 3))
+        uu = cg(self.A, self.b.flatten(), maxiter=25*int(pow(self.N_c, 0.33333)+0.5), tol=self.N_c * solver_precision,
+                M=self._getPreconditioner(preconditioner, self.A)).reshape((self.N_c, 3))
 
         # add the new displacements to the stored displacements
         self.U += uu * stepper
@@ -1025,6 +1392,395 @@ class FiniteBodyForces:
         #    self.U_target_mask = np.any(~np.isnan(self.U_target_mask), axis=1)
 
 
+@njit(parallel=True)
+def _get_energy_forces_and_stiffness(U, T, Phi, s, V, w, lookUpEpsilon, lookUpArguments, E, f, K, B_out, evaluate):
+    """
+    Calculates the energy E_t, the forces f_tmi and the stiffness K_tmril of each tetrahedron in a single pass.
+    As s*_tmb = Phi_tmj * s_bj, the sums over the beams are first reduced to moments, which are independent of the
+    corners m and r, and then contracted with Phi_tmj. Therefore, no array of the tetrahedra has a dimension N_b.
+    If K is empty, the stiffness is not calculated. If B_out is not empty, the 36 unique beam moments B_tjkil are
+    stored (see _pack_moments), to apply or to update the stiffness without a sum over the beams. If evaluate is not
+    empty, the stiffness and the beam moments are only calculated for the tetrahedra where it is True.
+    If f is empty, only the energy is calculated.
+    """
+    store_f = f.shape[0] > 0
+    store_K = K.shape[0] > 0
+    store_B = B_out.shape[0] > 0
+    evaluate_all = evaluate.shape[0] == 0
+    N_b = s.shape[0]
+    for t in prange(T.shape[0]):
+        evaluate_t = evaluate_all or evaluate[t]
+        # F is the linear map from T (the undeformed tetrahedron) to T' (the deformed tetrahedron)
+        # F_ij = d_ij + u_mi * Phi_mj  (i,j in {x,y,z}, m in {1,2,3,4})
+        F = np.eye(3)
+        for m in range(4):
+            for i in range(3):
+                for j in range(3):
+                    F[i, j] += U[T[t, m], i] * Phi[t, m, j]
+
+        # multiply the F tensor with the beam
+        # s'_ib = F_ij * s_bj  (i,j in {x,y,z}, b in [0, N_b])
+        s_bar = F @ s.T
+
+        # the "deformation" amount # p 54 equ 2 part in the parentheses
+        # s_b = |s'_ib|  (i in {x,y,z}, b in [0, N_b])
+        s_abs = np.sqrt(s_bar[0] ** 2 + s_bar[1] ** 2 + s_bar[2] ** 2)
+
+        epsilon_b, epsbar_b, epsbarbar_b = lookUpEpsilon(s_abs - 1, *lookUpArguments)
+
+        E[t] = 0
+        # the moments of the beams H_ji and B_jkil, from which f_tmi and K_tmril are calculated after the loop over
+        # the beams
+        H = np.zeros((3, 3))
+        B = np.zeros((3, 3, 3, 3))
+        for b in range(N_b):
+            # sum the energy of this tetrahedron
+            # E_t = eps_b * w_b * V_t
+            E[t] += epsilon_b[b] * w[b] * V[t]
+
+            if not store_f:
+                continue
+
+            #              eps'_b
+            # dEdsbar_b = - ------ * w_b * V_t
+            #                s_b
+            dEdsbar = - (epsbar_b[b] / s_abs[b]) * w[b] * V[t]
+
+            #                s_b * eps''_b - eps'_b
+            # dEdsbarbar_b = ---------------------- * w_b * V_t
+            #                       s_b**3
+            dEdsbarbar = ((s_abs[b] * epsbarbar_b[b] - epsbar_b[b]) / (s_abs[b] ** 3)) * w[b] * V[t]
+
+            # f_mi = s*_mb * s'_ib * dEds'_b = Phi_mj * H_ji  with  H_ji = sum_b s_bj * s'_ib * dEds'_b
+            # (i,j in {x,y,z}, m in {1,2,3,4})
+            for j in range(3):
+                for i in range(3):
+                    H[j, i] += s[b, j] * s_bar[i, b] * dEdsbar
+
+            if not (store_K or store_B) or not evaluate_t:
+                continue
+
+            #                              / |  |     \      / |  |     \                   / |    |     \
+            #  ___                   /  s'  w"| |s'| - 1 | - w' | |s'| - 1 |                w' | | s' | - 1 |             \
+            #  \         *     *     |   b    \ | b|     /      \ | b|     /                   \ |  b |     /             |
+            #   >  w  * s   * s    * | ------------------------------------ * s' * s'  + ---------------------- * delta   |
+            #  /    b    bm    br    |                  |s'|³                  ib   lb             |s'  |              li |
+            #  ---                   \                  | b|                                       |  b |                 /
+            #
+            # (i,l in {x,y,z}, m,r in {1,2,3,4}, b in [0, N_b])
+            # as s*_mb = Phi_mj * s_bj, the sum over the beams does not depend on m and r:
+            # K_mril = Phi_mj * Phi_rk * B_jkil  with  B_jkil = sum_b s_bj * s_bk * G_bil  and
+            # G_bil = 0.5 * (dEds''_b * s'_ib * s'_lb - delta_il * dEds'_b)
+            # (j,k in {x,y,z}), only the upper halves j <= k and i <= l of the symmetric B are summed
+            for i in range(3):
+                for l in range(i, 3):
+                    G = 0.5 * dEdsbarbar * s_bar[i, b] * s_bar[l, b]
+                    if i == l:
+                        G -= 0.5 * dEdsbar
+                    for j in range(3):
+                        for k in range(j, 3):
+                            B[j, k, i, l] += s[b, j] * s[b, k] * G
+
+        if store_f:
+            for m in range(4):
+                for i in range(3):
+                    f[t, m, i] = Phi[t, m, 0] * H[0, i] + Phi[t, m, 1] * H[1, i] + Phi[t, m, 2] * H[2, i]
+
+        if store_B and evaluate_t:
+            _pack_moments(B, B_out[t])
+
+        if store_K and evaluate_t:
+            # fill the lower halves of B
+            for j in range(3):
+                for k in range(j, 3):
+                    for i in range(3):
+                        for l in range(i, 3):
+                            B[k, j, i, l] = B[j, k, i, l]
+                            B[j, k, l, i] = B[j, k, i, l]
+                            B[k, j, l, i] = B[j, k, i, l]
+            _contract_moments(Phi[t], B, K[t])
+
+
+@njit()
+def _contract_moments(Phi, B, K):
+    """
+    The stiffness K_mril = Phi_mj * Phi_rk * B_jkil of one tetrahedron from its full 3x3x3x3 beam moments.
+    """
+    # K is symmetric under (m,i) <-> (r,l), only the 78 entries of the upper half are calculated
+    for m in range(4):
+        for r in range(m, 4):
+            for i in range(3):
+                for l in range(i if r == m else 0, 3):
+                    value = 0.0
+                    for j in range(3):
+                        for k in range(3):
+                            value += Phi[m, j] * Phi[r, k] * B[j, k, i, l]
+                    K[m, r, i, l] = value
+
+    # fill the lower half, K_rmli = K_mril
+    for m in range(4):
+        for r in range(m, 4):
+            for i in range(3):
+                for l in range(i + 1 if r == m else 0, 3):
+                    K[r, m, l, i] = K[m, r, i, l]
+
+
+@njit(parallel=True)
+def _get_stiffness_from_moments(Phi, B_packed, K):
+    """
+    Calculates the stiffness K_tmril = Phi_tmj * Phi_trk * B_tjkil of each tetrahedron from its packed beam moments
+    (see _pack_moments), without a sum over the beams.
+    """
+    for t in prange(Phi.shape[0]):
+        _contract_moments(Phi[t], _unpack_moments(B_packed[t]), K[t])
+
+
+# the index pairs (j,k) with j <= k of the symmetric beam moments B_jkil
+_symmetric_pairs = np.array([[0, 0], [0, 1], [0, 2], [1, 1], [1, 2], [2, 2]])
+
+
+@njit()
+def _pack_moments(B, out):
+    """
+    Stores the 36 unique entries B_jkil (j <= k, i <= l) of the beam moments, which are symmetric in (j,k) and in
+    (i,l), in the 6x6 array out.
+    """
+    for p in range(6):
+        j, k = _symmetric_pairs[p, 0], _symmetric_pairs[p, 1]
+        for q in range(6):
+            i, l = _symmetric_pairs[q, 0], _symmetric_pairs[q, 1]
+            out[p, q] = B[j, k, i, l]
+
+
+@njit()
+def _unpack_moments(packed):
+    """
+    The full 3x3x3x3 beam moments B_jkil from the 6x6 array of their unique entries (see _pack_moments).
+    """
+    B = np.zeros((3, 3, 3, 3))
+    for p in range(6):
+        j, k = _symmetric_pairs[p, 0], _symmetric_pairs[p, 1]
+        for q in range(6):
+            i, l = _symmetric_pairs[q, 0], _symmetric_pairs[q, 1]
+            B[j, k, i, l] = packed[p, q]
+            B[k, j, i, l] = packed[p, q]
+            B[j, k, l, i] = packed[p, q]
+            B[k, j, l, i] = packed[p, q]
+    return B
+
+
+@njit(parallel=True)
+def _apply_stiffness(p, T, Phi, B_packed, out):
+    """
+    Applies the stiffness K_tmril = Phi_tmj * Phi_trk * B_tjkil of each tetrahedron to the corner displacements p_tri,
+    without storing K_tmril.
+    """
+    for t in prange(T.shape[0]):
+        B = _unpack_moments(B_packed[t])
+
+        # q_kl = Phi_rk * p_rl  (k,l in {x,y,z}, r in {1,2,3,4})
+        q = np.zeros((3, 3))
+        for r in range(4):
+            c = T[t, r]
+            for k in range(3):
+                for l in range(3):
+                    q[k, l] += Phi[t, r, k] * p[c, l]
+
+        # v_ji = B_jkil * q_kl
+        v = np.zeros((3, 3))
+        for j in range(3):
+            for i in range(3):
+                for k in range(3):
+                    for l in range(3):
+                        v[j, i] += B[j, k, i, l] * q[k, l]
+
+        # K_mril * p_rl = Phi_mj * v_ji  (m in {1,2,3,4})
+        for m in range(4):
+            for i in range(3):
+                out[t, m, i] = Phi[t, m, 0] * v[0, i] + Phi[t, m, 1] * v[1, i] + Phi[t, m, 2] * v[2, i]
+
+
+@njit()
+def _get_stiffness_coordinates(T, var):
+    """
+    The linear index c1 * N_c + c2 of the 3x3 block in the global stiffness matrix for every block of the
+    N_T x 4 x 4 x 3 x 3 stiffness tensor. Blocks of rows that belong to fixed nodes are marked with -1.
+    """
+    N = var.shape[0]
+    coordinates = np.full((T.shape[0], 4, 4), -1, dtype=np.int64)
+    # iterate over all tetrahedra
+    for t in range(T.shape[0]):
+        # over all corners
+        for t1 in range(4):
+            c1 = T[t, t1]
+
+            if not var[c1]:
+                continue
+
+            for t2 in range(4):
+                # get two vertices of the tetrahedron
+                c2 = T[t, t2]
+
+                coordinates[t, t1, t2] = c1 * N + c2
+    return coordinates.ravel()
+
+
+@njit()
+def _scatter_add(values, scatter, out):
+    """
+    Sum the values into the slots of out given by scatter, values with a negative slot are ignored.
+    """
+    out[:] = 0
+    for k in range(values.shape[0]):
+        if scatter[k] >= 0:
+            out[scatter[k]] += values[k]
+
+
+@njit()
+def _scatter_add_blocks(values, scatter, out):
+    """
+    Add the 3x3 blocks of values to the blocks of out given by scatter, blocks with a negative slot are ignored.
+    """
+    for k in range(values.shape[0]):
+        if scatter[k] >= 0:
+            for i in range(3):
+                for j in range(3):
+                    out[scatter[k], i, j] += values[k, i, j]
+
+
+@njit(parallel=True)
+def _get_weighted_product(indptr, indices, data, weights, out_indptr, out_indices, out_data):
+    """
+    Calculates the blocks of the product C = K W K of a bsr matrix K with 3x3 blocks and the diagonal weights W into
+    the data of C, whose block sparsity pattern is already known.
+    """
+    N = indptr.shape[0] - 1
+    chunks = min(N, 4 * get_num_threads())
+    for chunk in prange(chunks):
+        # the position of each column in the current row of C
+        position = np.zeros(N, dtype=np.int64)
+        for i in range(chunk * N // chunks, (chunk + 1) * N // chunks):
+            for p in range(out_indptr[i], out_indptr[i + 1]):
+                position[out_indices[p]] = p
+                out_data[p] = 0
+            # C_ij,ab = sum_k sum_l K_ik,al * w_kl * K_kj,lb
+            for pk in range(indptr[i], indptr[i + 1]):
+                k = indices[pk]
+                for pj in range(indptr[k], indptr[k + 1]):
+                    q = position[indices[pj]]
+                    for a in range(3):
+                        for l in range(3):
+                            K_ik_w_k = data[pk, a, l] * weights[k * 3 + l]
+                            for b in range(3):
+                                out_data[q, a, b] += K_ik_w_k * data[pj, l, b]
+
+
+@njit(parallel=True)
+def _get_stiffness_diagonal(Phi, B_packed, out):
+    """
+    Calculates the diagonal blocks K_tmmil = Phi_tmj * Phi_tmk * B_tjkil of the stiffness of each tetrahedron.
+    """
+    for t in prange(Phi.shape[0]):
+        B = _unpack_moments(B_packed[t])
+        out[t] = 0
+        for m in range(4):
+            for j in range(3):
+                for k in range(3):
+                    Phi_Phi = Phi[t, m, j] * Phi[t, m, k]
+                    for i in range(3):
+                        for l in range(3):
+                            out[t, m, i, l] += Phi_Phi * B[j, k, i, l]
+
+
+class MatrixFreeStiffness:
+    """
+    The global stiffness matrix of a :py:class:`FiniteBodyForces` mesh, applied tetrahedron by tetrahedron from the
+    36 unique beam moments B_tjkil of each tetrahedron (dimensions N_T x 6 x 6), so that the memory per tetrahedron
+    does not depend on the number of beams. The sparse matrix is never assembled. Rows of fixed nodes are zero, as in
+    the assembled K_glo. With free_only, only the part K_ff which couples the degrees of freedom of the variable nodes
+    is applied.
+    """
+    def __init__(self, M: FiniteBodyForces, B: np.ndarray, free_only: bool = False):
+        self.M = M
+        self.B = B
+        self.free_only = free_only
+        if free_only:
+            self.shape = (M.free_dofs.shape[0], M.free_dofs.shape[0])
+        else:
+            self.shape = (M.N_c * 3, M.N_c * 3)
+
+    def __matmul__(self, other: np.ndarray) -> np.ndarray:
+        M = self.M
+        if self.free_only:
+            p = np.zeros((M.N_c, 3))
+            p[M.var] = np.reshape(other, (-1, 3))
+        else:
+            p = np.ascontiguousarray(other).reshape(M.N_c, 3)
+
+        # the stiffness times the displacements of the corners of each tetrahedron
+        out_T = np.zeros((M.N_T, 4, 3))
+        _apply_stiffness(p, M.T, M.Phi, self.B, out_T)
+
+        # sum the contributions of the tetrahedra for every node
+        out = np.zeros((M.N_c, 3))
+        _scatter_add(out_T.ravel(), M.force_scatter, out.ravel())
+        if self.free_only:
+            return out[M.var].reshape(np.shape(other))
+        out[~M.var] = 0
+
+        return out.reshape(np.shape(other))
+
+    def diagonal_blocks(self) -> np.ndarray:
+        """
+        The 3x3 blocks K_cc on the diagonal of the stiffness matrix, dimensions N_c x 3 x 3 (or only of the variable
+        nodes).
+        """
+        M = self.M
+        blocks_T = np.zeros((M.N_T, 4, 3, 3))
+        _get_stiffness_diagonal(M.Phi, self.B, blocks_T)
+
+        # sum the contributions of the tetrahedra for every node
+        blocks = np.zeros((M.N_c, 3, 3))
+        _scatter_add(blocks_T.ravel(), (M.T[:, :, None] * 9 + np.arange(9)[None, None, :]).ravel(), blocks.ravel())
+        if self.free_only:
+            return blocks[M.var]
+        blocks[~M.var] = 0
+
+        return blocks
+
+
+class RegularizationOperator:
+    """
+    The matrix A = I + K W K of the regularization, applied as x -> I x + K (W (K x)) without forming the product K W K,
+    which is much denser than K. I is the diagonal mask of the degrees of freedom with target displacements and W the
+    diagonal of the weights.
+    """
+    def __init__(self, K: ssp.bsr_matrix, weights: np.ndarray, mask: np.ndarray):
+        self.K = K
+        self.weights = weights
+        self.mask = mask
+        self.shape = K.shape
+
+    def __matmul__(self, other: np.ndarray) -> np.ndarray:
+        x = np.ravel(other)
+        return (self.mask * x + self.K @ (self.weights * (self.K @ x))).reshape(np.shape(other))
+
+    def diagonal_blocks(self) -> np.ndarray:
+        """
+        The 3x3 blocks on the diagonal of A, dimensions N_c x 3 x 3.
+        """
+        # (K W K)_(3c+a)(3c+b) = sum_k K_(3c+a)k w_k K_k(3c+b), the row 3c+a of K W times the row 3c+b of K^T
+        K = ssp.csr_matrix(self.K)
+        KW = ssp.csr_matrix(K.multiply(self.weights[None, :]))
+        KT = ssp.csr_matrix(K.T)
+        blocks = np.zeros((self.shape[0] // 3, 3, 3))
+        for a in range(3):
+            for b in range(3):
+                blocks[:, a, b] = np.asarray(KW[a::3].multiply(KT[b::3]).sum(axis=1)).ravel()
+        blocks[:, np.arange(3), np.arange(3)] += self.mask.reshape(-1, 3)
+        return blocks
+
+
 def save(filename: str, M: FiniteBodyForces):
     M.save(filename)
 
@@ -3,7 +3,7 @@ import time
 import numpy as np
 import scipy.sparse as ssp
 
-from .FiniteBodyForces import FiniteBodyForces
+from .FiniteBodyForces import FiniteBodyForces, RegularizationOperator
 from .conjugateGradient import cg
 from .stack3DHelper import crosscorrelateStacks, getSubstack, findLocalDisplacement
 
@@ -570,12 +570,16 @@ class VirtualBeads:
 
                 Stemp = self.S_0[c]
 
-    def _computeRegularizationAAndb(self, M, alpha):
-        KA = M.K_glo.multiply(np.repeat(self.localweight * alpha, 3)[None, :])
-        self.KAK = KA @ M.K_glo
-        self.A = self.I + self.KAK
+    def _computeRegularizationAAndb(self, M, alpha, explicit_kak=False):
+        weights = np.repeat(self.localweight * alpha, 3)
+        if explicit_kak:
+            self.KAK = M._computeKAK(weights)
+            self.A = self.I + self.KAK
+        else:
+            # apply A = I + K W K as operator, the product K W K is never formed
+            self.A = RegularizationOperator(M.K_glo, weights, self.I.diagonal())
 
-        self.b = (KA @ M.f_glo.ravel()).reshape(M.f_glo.shape)
+        self.b = (M.K_glo @ (weights * M.f_glo.ravel())).reshape(M.f_glo.shape)
 
         index = M.var * self.vbead
         self.b[index] += self.U_found[index] - M.U[index]
@@ -607,7 +611,7 @@ class VirtualBeads:
         np.savetxt(relrecname, relrec)
 
     def regularize(self, M, stepper=0.33, REG_SOLVER_PRECISION=1e-18, i_max=100, rel_conv_crit=0.01, alpha=1.0,
-                   method="huber", relrecname=None):
+                   method="huber", relrecname=None, preconditioner=None, explicit_kak=False):
         self.I = ssp.lil_matrix((self.vbead.shape[0] * 3, self.vbead.shape[0] * 3))
         self.I.setdiag(np.repeat(self.vbead, 3))
 
@@ -640,10 +644,10 @@ class VirtualBeads:
                 self.updateLocalWeigth(M, method)
 
             # compute A and b for the linear equation that solves the regularisation problem
-            self._computeRegularizationAAndb(M, alpha)
+            self._computeRegularizationAAndb(M, alpha, explicit_kak or preconditioner in ["multigrid", "amg"])
 
             # get and apply the displacements that solve the regularisation term
-            uu = self._solve_regularization_CG(M, stepper, REG_SOLVER_PRECISION)
+            uu = self._solve_regularization_CG(M, stepper, REG_SOLVER_PRECISION, preconditioner)
 
             # update the forces on each tetrahedron and the global stiffness tensor
             M._updateGloFAndK()
@@ -667,7 +671,7 @@ class VirtualBeads:
 
         return relrec
 
-    def _solve_regularization_CG(self, M, stepper=0.33, REG_SOLVER_PRECISION=1e-18):
+    def _solve_regularization_CG(self, M, stepper=0.33, REG_SOLVER_PRECISION=1e-18, preconditioner=None):
         """
         Solve the displacements from the current stiffness tensor using conjugate gradient.
         """
@@ -675,7 +679,7 @@ class VirtualBeads:
         # solve the conjugate gradient which solves the equation A x = b for x
         # where A is (I - KAK) (K: stiffness matrix, A: weight matrix) and b is (u_meas - u - KAf)
         uu = cg(self.A, self.b.flatten(), maxiter=25 * int(pow(M.N_c, 0.33333) + 0.5),
-                tol=M.N_c * REG_SOLVER_PRECISION).reshape((M.N_c, 3))
+                tol=M.N_c * REG_SOLVER_PRECISION, M=M._getPreconditioner(preconditioner, self.A)).reshape((M.N_c, 3))
 
         # add the new displacements to the stored displacements
         self.M.U += uu * stepper
@@ -1,3 +1,4 @@
+import itertools
 import numpy as np
 
 
@@ -47,5 +48,106 @@ def buildBeams(N: int) -> np.ndarray:
     return np.array(beams)
 
 
+# the Lebedev rules, given by their orbits under the octahedral group: (orbit type, parameter, weight)
+_lebedev_rules = {
+    3: [(1, 0, 1 / 6)],
+    5: [(1, 0, 1 / 15), (3, 0, 3 / 40)],
+    7: [(1, 0, 1 / 21), (2, 0, 4 / 105), (3, 0, 9 / 280)],
+    9: [(1, 0, 1 / 105), (3, 0, 9 / 280), (5, 0.4597008433809831, 1 / 35)],
+    11: [(1, 0, 4 / 315), (2, 0, 64 / 2835), (3, 0, 27 / 1280), (4, 1 / np.sqrt(11), 14641 / 725760)],
+    17: [(1, 0, 0.3828270494937162e-2), (3, 0, 0.9793737512487512e-2), (4, 0.1851156353447362, 0.8211737283191111e-2),
+         (4, 0.6904210483822922, 0.9942814891178103e-2), (4, 0.3956894730559419, 0.9595471336070963e-2),
+         (5, 0.4783690288121502, 0.9694996361663028e-2)],
+}
+
+
+def _octahedralOrbit(kind: int, a: float) -> np.ndarray:
+    """
+    The points of the sphere generated by the octahedral group from (1, 0, 0), (0, 1, 1)/sqrt(2), (1, 1, 1)/sqrt(3),
+    (a, a, sqrt(1-2a^2)) or (a, sqrt(1-a^2), 0) for the kinds 1 to 5.
+    """
+    point = [(1, 0, 0), (0, np.sqrt(0.5), np.sqrt(0.5)), (np.sqrt(1 / 3),) * 3,
+             (a, a, np.sqrt(1 - 2 * a ** 2)), (a, np.sqrt(1 - a ** 2), 0)][kind - 1]
+    points = [np.array(permutation) * signs for permutation in itertools.permutations(point)
+              for signs in itertools.product([1, -1], repeat=3)]
+    # remove the duplicates of points with repeated or zero coordinates
+    return np.unique(np.round(points, 15) + 0.0, axis=0)
+
+
+def buildLebedevBeams(degree: int = 11) -> (np.ndarray, np.ndarray):
+    """
+    Builds the beams and weights of a Lebedev quadrature rule of the sphere, which integrates all polynomials up to the
+    given degree exactly. Available degrees are 3, 5, 7, 9, 11 and 17 (6, 14, 26, 38, 50 and 110 beams).
+    """
+    if degree not in _lebedev_rules:
+        raise ValueError("No Lebedev rule of degree %d, available are %s." % (degree, list(_lebedev_rules)))
+    beams = []
+    weights = []
+    for kind, a, weight in _lebedev_rules[degree]:
+        points = _octahedralOrbit(kind, a)
+        beams.append(points)
+        weights.append(np.full(points.shape[0], weight))
+    return np.concatenate(beams), np.concatenate(weights)
+
+
+def buildGaussProductBeams(N: int) -> (np.ndarray, np.ndarray):
+    """
+    Builds the beams and weights of a product rule of the sphere with N Gauss-Legendre nodes in cos(theta) and 2N
+    equidistant angles phi, which integrates all polynomials up to the degree 2N-1 exactly. Useful as high order
+    reference.
+    """
+    cos_theta, w_theta = np.polynomial.legendre.leggauss(N)
+    phi = np.pi / N * (np.arange(2 * N) + 0.5)
+    sin_theta = np.sqrt(1 - cos_theta ** 2)
+    beams = np.array([np.outer(sin_theta, np.cos(phi)), np.outer(sin_theta, np.sin(phi)),
+                      np.outer(cos_theta, np.ones_like(phi))]).reshape(3, -1).T
+    weights = np.repeat(w_theta / (4 * N), 2 * N)
+    return beams, weights
+
+
+def buildIcosahedronBeams() -> (np.ndarray, np.ndarray):
+    """
+    Builds the beams of the 12 vertices of an icosahedron, a spherical 5-design with uniform weights.
+    """
+    g = (1 + np.sqrt(5)) / 2
+    beams = np.array([p for a, b in itertools.product([1, -1], [g, -g])
+                      for p in [(0, a, b), (a, b, 0), (b, 0, a)]]) / np.sqrt(1 + g ** 2)
+    return beams, np.full(12, 1 / 12)
+
+
+def mergeAntipodalBeams(beams: np.ndarray, weights: np.ndarray = None) -> (np.ndarray, np.ndarray):
+    """
+    Merges beams which point in opposite directions. A fiber along s is stretched just as much as a fiber along -s,
+    therefore both can be represented by one beam that carries the summed weight.
+
+    Parameters
+    ----------
+    beams : ndarray
+        The unit vectors of the beams, dimensions N_b x 3.
+    weights : ndarray, optional
+        The weight of each beam. Defaults to uniform weights.
+
+    Returns
+    -------
+    beams : ndarray
+        The remaining beams.
+    weights : ndarray
+        The weights of the remaining beams, normalized to sum up to 1.
+    """
+    beams = np.asarray(beams, dtype=float)
+    if weights is None:
+        weights = np.ones(beams.shape[0])
+    weights = np.array(weights, dtype=float)
+
+    # find for every beam the beam pointing in the opposite direction (if there is one)
+    partner = np.argmin(beams @ beams.T, axis=1)
+    antipodal = np.linalg.norm(beams[partner] + beams, axis=1) < 1e-8
+    # keep the beam with the lower index of each pair and add the weight of its partner
+    keep = ~antipodal | (np.arange(beams.shape[0]) < partner)
+    weights[antipodal & keep] += weights[partner[antipodal & keep]]
+
+    return beams[keep], weights[keep] / np.sum(weights[keep])
+
+
 def saveBeams(beams: np.ndarray, fname: str):
     np.savetxt(fname, beams)
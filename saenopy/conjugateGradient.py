@@ -1,52 +1,402 @@
 import numpy as np
+import scipy.sparse as ssp
+import scipy.sparse.linalg
+from numba import njit, prange
 
 
-def cg(A: np.ndarray, b: np.ndarray, maxiter: int = 1000, tol: float = 0.00001):
-    """ solve the equation Ax=b with the conjugate gradient method """
-    def norm(x):
-        return np.inner(x.flatten(), x.flatten())
+@njit(parallel=True)
+def _csr_matvec(indptr, indices, data, x, out):
+    """ out = A x for a csr matrix """
+    for i in prange(indptr.shape[0] - 1):
+        value = 0.0
+        for p in range(indptr[i], indptr[i + 1]):
+            value += data[p] * x[indices[p]]
+        out[i] = value
+
+
+@njit(parallel=True)
+def _bsr_matvec(indptr, indices, data, x, out):
+    """ out = A x for a bsr matrix with 3x3 blocks """
+    for i in prange(indptr.shape[0] - 1):
+        v0 = 0.0
+        v1 = 0.0
+        v2 = 0.0
+        for p in range(indptr[i], indptr[i + 1]):
+            j = indices[p] * 3
+            v0 += data[p, 0, 0] * x[j] + data[p, 0, 1] * x[j + 1] + data[p, 0, 2] * x[j + 2]
+            v1 += data[p, 1, 0] * x[j] + data[p, 1, 1] * x[j + 1] + data[p, 1, 2] * x[j + 2]
+            v2 += data[p, 2, 0] * x[j] + data[p, 2, 1] * x[j + 1] + data[p, 2, 2] * x[j + 2]
+        out[i * 3] = v0
+        out[i * 3 + 1] = v1
+        out[i * 3 + 2] = v2
+
+
+@njit(parallel=True)
+def _symmetric_bsr_matvec(indptr, indices, lower_indptr, lower_indices, lower_blocks, data, x, out):
+    """ out = A x for a symmetric matrix of which the 3x3 blocks on and above the diagonal are stored """
+    for i in prange(indptr.shape[0] - 1):
+        v0 = 0.0
+        v1 = 0.0
+        v2 = 0.0
+        # the stored blocks A_ij with j >= i
+        for p in range(indptr[i], indptr[i + 1]):
+            j = indices[p] * 3
+            v0 += data[p, 0, 0] * x[j] + data[p, 0, 1] * x[j + 1] + data[p, 0, 2] * x[j + 2]
+            v1 += data[p, 1, 0] * x[j] + data[p, 1, 1] * x[j + 1] + data[p, 1, 2] * x[j + 2]
+            v2 += data[p, 2, 0] * x[j] + data[p, 2, 1] * x[j + 1] + data[p, 2, 2] * x[j + 2]
+        # the blocks A_ij with j < i, which are the transposes of the stored blocks A_ji
+        for p in range(lower_indptr[i], lower_indptr[i + 1]):
+            q = lower_blocks[p]
+            j = lower_indices[p] * 3
+            v0 += data[q, 0, 0] * x[j] + data[q, 1, 0] * x[j + 1] + data[q, 2, 0] * x[j + 2]
+            v1 += data[q, 0, 1] * x[j] + data[q, 1, 1] * x[j + 1] + data[q, 2, 1] * x[j + 2]
+            v2 += data[q, 0, 2] * x[j] + data[q, 1, 2] * x[j + 1] + data[q, 2, 2] * x[j + 2]
+        out[i * 3] = v0
+        out[i * 3 + 1] = v1
+        out[i * 3 + 2] = v2
+
+
+@njit(parallel=True)
+def _dot(x, y):
+    """ the inner product x y """
+    value = 0.0
+    for i in prange(x.shape[0]):
+        value += x[i] * y[i]
+    return value
+
+
+@njit(parallel=True)
+def _update_x_and_r(alpha, p, Ap, x, r):
+    """ x += alpha p and r -= alpha Ap in place, returns the new r r """
+    rr = 0.0
+    for i in prange(x.shape[0]):
+        x[i] += alpha * p[i]
+        r[i] -= alpha * Ap[i]
+        rr += r[i] * r[i]
+    return rr
+
+
+@njit(parallel=True)
+def _update_p(z, beta, p):
+    """ p = z + beta p in place """
+    for i in prange(p.shape[0]):
+        p[i] = z[i] + beta * p[i]
+
+
+def _matvec(A, x: np.ndarray, out: np.ndarray) -> np.ndarray:
+    """
+    out = A x, with compiled parallel kernels for csr and 3x3 bsr matrices and the @ operator for everything else.
+    """
+    format = getattr(A, "format", None)
+    if isinstance(A, SymmetricBlockMatrix):
+        _symmetric_bsr_matvec(A.indptr, A.indices, A.lower_indptr, A.lower_indices, A.lower_blocks, A.data, x, out)
+    elif format == "csr" and A.dtype == np.float64:
+        _csr_matvec(A.indptr, A.indices, A.data, x, out)
+    elif format == "bsr" and A.blocksize == (3, 3) and A.dtype == np.float64:
+        _bsr_matvec(A.indptr, A.indices, A.data, x, out)
+    else:
+        out[:] = A @ x
+    return out
+
+
+def cg(A: np.ndarray, b: np.ndarray, maxiter: int = 1000, tol: float = 0.00001, M=None, x0: np.ndarray = None):
+    """ solve the equation Ax=b with the conjugate gradient method, optionally preconditioned with M and started
+    from x0 """
+    shape = np.shape(b)
+    b = np.ascontiguousarray(b, dtype=np.float64).ravel()
 
     # calculate the total force "amplitude"
-    normb = norm(b)
+    normb = _dot(b, b)
 
     # if it is not 0 (always has to be positive)
     if normb == 0:
-        return 0
+        return np.zeros(shape)
 
-    x = np.zeros_like(b)
+    x = np.zeros_like(b) if x0 is None else np.array(x0, dtype=np.float64).ravel()
+
+    # the work vectors are allocated once and updated in place
+    Ap = np.zeros_like(b)
 
     # the difference between the desired force deviations and the current force deviations
-    r = b - A @ x
+    r = b - _matvec(A, x, Ap)
+
+    # apply the preconditioner
+    z = r if M is None else M @ r
 
     # and store it also in pp
-    p = r
+    p = z.copy()
 
     # calculate the total force deviation "amplitude"
-    resid = norm(p)
+    resid = _dot(r, z)
 
     # iterate maxiter iterations
     for i in range(1, maxiter + 1):
-        Ap = A @ p
+        _matvec(A, p, Ap)
 
-        alpha = resid / np.sum(p * Ap)
+        alpha = resid / _dot(p, Ap)
 
-        x = x + alpha * p
-        r = r - alpha * Ap
-
-        rsnew = norm(r)
+        rsnew = _update_x_and_r(alpha, p, Ap, x, r)
 
         # check if we are already below the convergence tolerance
         if rsnew < tol * normb:
             break
 
+        # apply the preconditioner
+        if M is not None:
+            z = M @ r
+            rsnew = _dot(r, z)
+        else:
+            z = r
+
         beta = rsnew / resid
 
         # update pp and resid
-        p = r + beta * p
+        _update_p(z, beta, p)
         resid = rsnew
 
         # print status every 100 frames
         if i % 100 == 0:
-            print(i, ":", resid, "alpha=", alpha, "du=", np.sum(x ** 2))  # , end="\r")
+            print(i, ":", resid, "alpha=", alpha, "du=", _dot(x, x))  # , end="\r")
+
+    return x.reshape(shape)
+
+
+def getDiagonalBlocks(A) -> np.ndarray:
+    """
+    Get the 3x3 blocks on the diagonal of a matrix with 3 degrees of freedom per node, dimensions N_c x 3 x 3.
+    """
+    # matrix free operators provide their diagonal blocks themselves
+    if hasattr(A, "diagonal_blocks"):
+        return A.diagonal_blocks()
+
+    # block sparse matrices store the 3x3 blocks directly
+    if getattr(A, "format", None) == "bsr" and A.blocksize == (3, 3):
+        rows = np.repeat(np.arange(A.indptr.shape[0] - 1), np.diff(A.indptr))
+        diagonal = A.indices == rows
+        blocks = np.zeros((A.shape[0] // 3, 3, 3))
+        np.add.at(blocks, rows[diagonal], A.data[diagonal])
+        return blocks
+
+    N_c = A.shape[0] // 3
+    blocks = np.zeros((N_c, 3, 3))
+    c = np.arange(N_c) * 3
+    for k in range(-2, 3):
+        # the k-th diagonal contains A[r, r+k] for k >= 0 and A[r-k, r] for k < 0
+        diagonal = A.diagonal(k)
+        for i in range(max(0, -k), min(3, 3 - k)):
+            blocks[:, i, i + k] = diagonal[c + min(i, i + k)]
+    return blocks
+
+
+class SymmetricBlockMatrix:
+    """
+    A symmetric matrix of 3x3 blocks, of which only the blocks on and above the diagonal are stored, as block sparse
+    rows with sorted indices. The blocks below the diagonal are applied as the transposes of the stored blocks.
+
+    Parameters
+    ----------
+    data : ndarray
+        The stored blocks, dimensions N_blocks x 3 x 3.
+    indices : ndarray
+        The block column of each stored block.
+    indptr : ndarray
+        The start of each block row in data and indices.
+    """
+    def __init__(self, data: np.ndarray, indices: np.ndarray, indptr: np.ndarray):
+        self.data = data
+        self.indices = indices
+        self.indptr = indptr
+        N = indptr.shape[0] - 1
+        self.shape = (N * 3, N * 3)
+
+        # the blocks strictly above the diagonal, sorted by their column, are the blocks below the diagonal sorted by
+        # their row
+        rows = np.repeat(np.arange(N), np.diff(indptr))
+        upper = np.where(indices > rows)[0]
+        self.lower_blocks = upper[np.argsort(indices[upper], kind="stable")]
+        self.lower_indices = rows[self.lower_blocks]
+        self.lower_indptr = np.concatenate(([0], np.cumsum(np.bincount(indices[upper], minlength=N))))
+
+    def __matmul__(self, other: np.ndarray) -> np.ndarray:
+        return _matvec(self, np.ascontiguousarray(other, dtype=np.float64).ravel(),
+                       np.zeros(self.shape[0])).reshape(np.shape(other))
+
+    def diagonal_blocks(self) -> np.ndarray:
+        """
+        The 3x3 blocks on the diagonal, dimensions N x 3 x 3.
+        """
+        rows = np.repeat(np.arange(self.indptr.shape[0] - 1), np.diff(self.indptr))
+        diagonal = self.indices == rows
+        blocks = np.zeros((self.shape[0] // 3, 3, 3))
+        blocks[rows[diagonal]] = self.data[diagonal]
+        return blocks
+
+    def tobsr(self) -> ssp.bsr_matrix:
+        """
+        The full matrix with the blocks on both sides of the diagonal.
+        """
+        upper = ssp.bsr_matrix((self.data, self.indices, self.indptr), shape=self.shape)
+        lower = ssp.bsr_matrix((self.data[self.lower_blocks].transpose(0, 2, 1), self.lower_indices,
+                                self.lower_indptr), shape=self.shape)
+        return (upper + lower).tobsr(blocksize=(3, 3))
+
+    def tocsr(self) -> ssp.csr_matrix:
+        return self.tobsr().tocsr()
+
+
+class JacobiPreconditioner:
+    """
+    Preconditions with the inverse of the diagonal of the matrix.
+    """
+    def __init__(self, A):
+        diagonal = np.diagonal(getDiagonalBlocks(A), axis1=1, axis2=2).ravel()
+        # rows without an entry (e.g. fixed nodes) are left untouched
+        self.inverse = np.ones_like(diagonal)
+        self.inverse[diagonal != 0] = 1 / diagonal[diagonal != 0]
+
+    def __matmul__(self, other: np.ndarray) -> np.ndarray:
+        return self.inverse * other
+
+
+class BlockJacobiPreconditioner:
+    """
+    Preconditions with the inverse of the 3x3 nodal blocks on the diagonal of the matrix.
+    """
+    def __init__(self, A):
+        blocks = getDiagonalBlocks(A)
+        # nodes with a singular block (e.g. fixed nodes) are left untouched
+        invertible = np.abs(np.linalg.det(blocks)) > 0
+        self.inverse = np.tile(np.eye(3), (blocks.shape[0], 1, 1))
+        self.inverse[invertible] = np.linalg.inv(blocks[invertible])
+
+    def __matmul__(self, other: np.ndarray) -> np.ndarray:
+        return np.einsum("nij,nj->ni", self.inverse, other.reshape(-1, 3)).reshape(other.shape)
+
+
+def getJacobiSpectralRadius(A, smoother, iterations: int = 15) -> float:
+    """
+    Estimates the spectral radius of D^-1 A with the power method, where the smoother applies D^-1 (e.g. a
+    :py:class:`BlockJacobiPreconditioner`).
+    """
+    x = np.random.RandomState(0).rand(A.shape[0])
+    rho = 1
+    for i in range(iterations):
+        x = smoother @ (A @ x)
+        rho = np.linalg.norm(x)
+        x /= rho
+    return rho
+
+
+class MultigridPreconditioner:
+    """
+    Preconditions with one multigrid V-cycle. The coarse matrices are the Galerkin products P^T A P of the given
+    prolongations, which map between the degrees of freedom of two levels (3 per node, stored consecutively). Damped
+    3x3 block-Jacobi sweeps are used as smoother and the coarsest level is solved directly.
+
+    Parameters
+    ----------
+    A : sparse matrix
+        The matrix of the linear system.
+    prolongations : list
+        The sparse prolongations, from the finest to the coarsest level.
+    free : ndarray, optional
+        A bool for each degree of freedom whether it is variable. Fixed degrees of freedom are excluded from the coarse
+        levels and their residuum is left untouched.
+    smoothing_steps : int, optional
+        The number of smoothing sweeps before and after the coarse grid correction.
+    omega : float, optional
+        The damping of the block-Jacobi smoother, relative to the inverse of the spectral radius of D^-1 A, which is
+        estimated on every level.
+    """
+    def __init__(self, A, prolongations: list, free: np.ndarray = None, smoothing_steps: int = 2, omega: float = 1.0):
+        if not ssp.issparse(A):
+            raise ValueError("Multigrid preconditioning needs an assembled sparse matrix.")
+        self.smoothing_steps = smoothing_steps
+        self.omega = omega
+
+        self.prolongations = list(prolongations)
+        self.free = free
+        if free is not None:
+            # corrections of the coarse levels do not act on fixed degrees of freedom
+            self.prolongations[0] = ssp.diags(free.astype(float)) @ self.prolongations[0]
+
+        self.update(A)
+
+    def update(self, A):
+        """
+        Recompute the coarse matrices and smoothers for new values of the matrix.
+        """
+        A = ssp.csr_matrix(A)
+        if self.free is not None:
+            # decouple the fixed degrees of freedom
+            D = ssp.diags(self.free.astype(float))
+            A = (D @ A @ D + ssp.diags(1 - self.free.astype(float))).tocsr()
+
+        self.matrices = [A]
+        for P in self.prolongations:
+            A = (P.T @ A @ P).tocsr()
+            # degrees of freedom that do not couple to any fine degree of freedom are kept at zero
+            empty = A.diagonal() == 0
+            if np.any(empty):
+                A = (A + ssp.diags(empty.astype(float))).tocsr()
+            self.matrices.append(A)
+
+        self.smoothers = [BlockJacobiPreconditioner(A) for A in self.matrices[:-1]]
+        # the damping of each level, the smoother only converges for omega_l * rho_l < 2
+        self.omegas = [self.omega / getJacobiSpectralRadius(A, smoother)
+                       for A, smoother in zip(self.matrices, self.smoothers)]
+        self.coarse_solver = scipy.sparse.linalg.factorized(self.matrices[-1].tocsc())
+
+    def _vcycle(self, level: int, b: np.ndarray) -> np.ndarray:
+        # solve the coarsest level directly
+        if level == len(self.prolongations):
+            return self.coarse_solver(b)
+
+        A = self.matrices[level]
+        smoother = self.smoothers[level]
+        omega = self.omegas[level]
+
+        # pre-smoothing
+        x = omega * (smoother @ b)
+        for i in range(self.smoothing_steps - 1):
+            x += omega * (smoother @ (b - A @ x))
+
+        # correct with the solution of the residuum on the coarser level
+        P = self.prolongations[level]
+        x += P @ self._vcycle(level + 1, P.T @ (b - A @ x))
+
+        # post-smoothing
+        for i in range(self.smoothing_steps):
+            x += omega * (smoother @ (b - A @ x))
+
+        return x
+
+    def __matmul__(self, other: np.ndarray) -> np.ndarray:
+        return self._vcycle(0, other.ravel()).reshape(other.shape)
+
+
+def getPreconditioner(name: str, A):
+    """
+    Create the preconditioner with the given name for the matrix A.
 
-    return x
\ No newline at end of file
+    Parameters
+    ----------
+    name : str
+        The preconditioner to use:
+            None (no preconditioning)
+            "jacobi"
+            "block_jacobi" (3x3 nodal blocks)
+            "amg" (smoothed aggregation algebraic multigrid)
+    A : sparse matrix, operator
+        The matrix of the linear system.
+    """
+    if name is None:
+        return None
+    if name == "jacobi":
+        return JacobiPreconditioner(A)
+    if name == "block_jacobi":
+        return BlockJacobiPreconditioner(A)
+    if name == "amg":
+        from .multigridHelper import getAggregationProlongations
+        return MultigridPreconditioner(A, getAggregationProlongations(A))
+    raise ValueError("Unknown preconditioner %s" % name)
@@ -19,6 +19,7 @@ def makeBoxmesh(mesh, CFG):
     mesh.currentgrain = 1
 
     nx = CFG["BM_N"]
+    mesh.boxmesh_nx = nx
     dx = CFG["BM_GRAIN"]
 
     rin = CFG["BM_RIN"]
@@ -1,5 +1,5 @@
 import numpy as np
-from .buildBeams import buildBeams
+from .buildBeams import buildBeams, mergeAntipodalBeams, buildGaussProductBeams
 from .materials import Material
 from typing import Sequence
 
@@ -89,6 +89,57 @@ def combineQuadrature(p1_w1: Sequence, p2_w2: Sequence) -> (np.ndarray, np.ndarr
     return x, y, w
 
 
+def getBeams(s=30) -> (np.ndarray, np.ndarray):
+    """
+    The beams and their weights for the integration over the body angle. s can be the number of beams, an array of
+    beams or a tuple of beams and weights. Beams pointing in opposite directions are merged.
+    """
+    if isinstance(s, int):
+        s = buildBeams(s)
+    if isinstance(s, tuple):
+        return mergeAntipodalBeams(*s)
+    return mergeAntipodalBeams(s)
+
+
+def getBeamQuadratureError(material: Material, s, strain: float = 0.1, reference: int = 64) -> float:
+    """
+    The accuracy of a set of beams for a material. The energy density W is integrated over the beams for shear,
+    extension and compression up to the given strain and compared to a Gauss product rule with the given order as
+    reference. The deformations are rotated randomly, so that they are not aligned with the symmetry axes of the beams.
+
+    Parameters
+    ----------
+    material : :py:class:`~.materials.Material`
+        The material model to use.
+    s : int, ndarray, tuple
+        The beams to test, see getBeams.
+    strain : float, optional
+        The largest strain to test.
+    reference : int, optional
+        The order of the reference rule (see buildGaussProductBeams).
+
+    Returns
+    -------
+    error : float
+        The largest relative error of the energy density.
+    """
+    F = []
+    for gamma in np.linspace(0, strain, 6)[1:]:
+        shear = np.eye(3)
+        shear[0, 1] = gamma
+        F.extend([shear, np.diag([1 + gamma, 1, 1]), np.diag([1 - gamma, 1, 1])])
+    R = np.linalg.qr(np.random.RandomState(0).normal(size=(3, 3)))[0]
+    F = R @ np.array(F) @ R.T
+
+    def getEnergyDensity(s):
+        beams, weights = getBeams(s)
+        s_abs = np.linalg.norm(F @ beams.T, axis=-2)
+        return np.average(material.energy(s_abs - 1), axis=-1, weights=weights)
+
+    W_reference = getEnergyDensity(buildGaussProductBeams(reference))
+    return np.max(np.abs(getEnergyDensity(s) - W_reference) / np.abs(W_reference))
+
+
 def getShearRheometerStress(gamma: np.ndarray, material: Material, s: np.ndarray = None) -> (np.ndarray, np.ndarray):
     r"""
     Get the stress for a given strain of the material in a shear rheometer.
@@ -123,8 +174,7 @@ def getShearRheometerStress(gamma: np.ndarray, material: Material, s: np.ndarray
     stress : ndarray
         The resulting stress.
     """
-    if s is None:
-        s = buildBeams(30)
+    s, w = getBeams(30 if s is None else s)
 
     F = np.eye(3)
     F = np.tile(F, (gamma.shape[0], 1, 1))
@@ -136,14 +186,13 @@ def getShearRheometerStress(gamma: np.ndarray, material: Material, s: np.ndarray
 
     eps = material.energy(s_abs - 1)
 
-    W = np.mean(eps, axis=-1)
+    W = np.average(eps, axis=-1, weights=w)
     dW = np.diff(W) / np.diff(gamma)
     return gamma[:-1] + np.diff(gamma) / 2, dW
 
 
 def getShearRheometerStressRotation(gamma, material, H=1e-3, R=10e-3, s=30, q=2):
-    if isinstance(s, int):
-        s = buildBeams(s)
+    s, w_s = getBeams(s)
 
     x_r, z_h, w = combineQuadrature(getQuadrature(q, 0, 1), getQuadrature(q, 0, 1))
 
@@ -162,7 +211,7 @@ def getShearRheometerStressRotation(gamma, material, H=1e-3, R=10e-3, s=30, q=2)
     s_abs = np.linalg.norm(s_bar, axis=-2)
     eps = material.energy(s_abs - 1)
 
-    W = np.mean(eps, axis=-1)
+    W = np.average(eps, axis=-1, weights=w_s)
     W = np.average(W, axis=-1, weights=w)
     dW = np.diff(W) / np.diff(gamma)
 
@@ -204,8 +253,7 @@ def getStretchThinning(lambda_h, lambda_v, material, s=None):
     lambda_v : ndarray
         The vertical stretching that minimizes the energy for the horizontal stretching.
     """
-    if s is None:
-        s = buildBeams(30)
+    s, w = getBeams(30 if s is None else s)
 
     F00, F22 = np.meshgrid(lambda_v, lambda_h)
     F11 = np.ones_like(F00)
@@ -214,7 +262,7 @@ def getStretchThinning(lambda_h, lambda_v, material, s=None):
     s_bar = np.einsum("hvj,bj->hvjb", F, s)
     s_abs = np.linalg.norm(s_bar, axis=-2)
     eps = material.energy(s_abs - 1)
-    W = np.mean(eps, axis=-1)
+    W = np.average(eps, axis=-1, weights=w)
 
     index = np.argmin(W, axis=1)
     return lambda_h, lambda_v[index]
@@ -255,8 +303,7 @@ def getExtensionalRheometerStress(epsilon, material, s=None):
     stress : ndarray
         The resulting stress.
     """
-    if s is None:
-        s = buildBeams(30)
+    s, w = getBeams(30 if s is None else s)
 
     F = np.eye(3)
     F = np.tile(F, (epsilon.shape[0], 1, 1))
@@ -268,7 +315,7 @@ def getExtensionalRheometerStress(epsilon, material, s=None):
 
     eps = material.energy(s_abs - 1)
 
-    W = np.mean(eps, axis=-1)
+    W = np.average(eps, axis=-1, weights=w)
     dW = np.diff(W) / np.diff(epsilon)
     return epsilon[:-1] + np.diff(epsilon) / 2, dW
 
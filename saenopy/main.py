@@ -317,7 +317,7 @@ def main():
                 if CFG["REGMETHOD"] == "laplace":
                     B.computeConconnections_Laplace(M)
 
-                M._updateGloFAndK()
+                M.computeForces()
 
                 results["L"] = "0.0"
                 results["MISFIT"] = "0.0"
@@ -340,7 +340,7 @@ def main():
                 M._computePhi()
                 M._computeConnections()
 
-                M._updateGloFAndK()
+                M.computeForces()
 
                 #  ------ END OF MODULE computeResults -------------------------------------- // /
 
@@ -1,3 +1,6 @@
+import os
+import hashlib
+import warnings
 import numpy as np
 from numba import njit
 
@@ -17,7 +20,10 @@ def saveEpsilon(epsilon, fname, CFG):
     np.save(fname.replace(".dat", ".npy"), np.array([lambd, epsilon]).T)
 
 
-def sampleAndIntegrateFunction(func, min, max, step, zero_point=0, maximal_value=10e10):
+def sampleAndIntegrateTables(func, min, max, step, zero_point=0, maximal_value=10e10):
+    """
+    Samples the function (the stiffness) with the given step and integrates it twice numerically.
+    """
     def iToX(i):
         return i * step + min
 
@@ -38,37 +44,205 @@ def sampleAndIntegrateFunction(func, min, max, step, zero_point=0, maximal_value
     int_int_y = np.cumsum(int_y * step)
     int_int_y -= int_int_y[xToI(zero_point)]
 
-    @njit()
-    def lookUpY(x):
-        shape = x.shape
-        x = x.flatten()
-        # we now have to pass this though the non-linearity function w (material model)
-        # this function has been discretized and we interpolate between these discretisation steps
+    return y, int_y, int_int_y
+
+
+@njit()
+def lookUpTables(x, min, max, step, y, int_y, int_int_y):
+    """
+    Interpolates the sampled function and its two integrals (see :py:func:`sampleAndIntegrateTables`) at x. The tables
+    are arguments, so that the compiled function can be reused for all tables.
+    """
+    shape = x.shape
+    x = x.flatten()
+    # we now have to pass this though the non-linearity function w (material model)
+    # this function has been discretized and we interpolate between these discretisation steps
 
-        # the discretisation step
-        li = np.floor((x - min) / step)
+    # the discretisation step
+    li = np.floor((x - min) / step)
 
-        # the part between the two steps
-        dli = (x - min) / step - li
+    # the part between the two steps
+    dli = (x - min) / step - li
+
+    # if we are at the border of the discretisation, we stick to the end
+    max_index = li > ((max - min) / step) - 2
+    li[max_index] = int(((max - min) / step) - 2)
+    dli[max_index] = 0
+
+    # convert now to int after fixing the maximum
+    lii = li.astype(np.int64)
+
+    # interpolate between the two discretisation steps
+    res0 = (1 - dli) * int_int_y[lii] + dli * int_int_y[lii + 1]
+    res1 = (1 - dli) * int_y[lii] + dli * int_y[lii + 1]
+    res2 = (1 - dli) * y[lii] + dli * y[lii + 1]
+
+    return res0.reshape(shape), res1.reshape(shape), res2.reshape(shape)
+
+
+def fitPiecewisePolynomial(func, min, max, zero_point=0, maximal_value=10e10, degree=8, tolerance=1e-8,
+                           min_width=1e-9):
+    """
+    Approximates the function (the stiffness) with piecewise Chebyshev polynomials and integrates them twice
+    analytically. The intervals are bisected until the polynomial deviates from the function by less than tolerance,
+    relative to max(|func(x)|, |func(zero_point)|), at 8 times as many test points as the degree.
+
+    Returns
+    -------
+    breakpoints : ndarray
+        The borders of the intervals, dimensions N+1.
+    coefficients : ndarray
+        The Chebyshev coefficients of the energy, its first and its second derivative on each interval, dimensions
+        N x 3 x degree+3.
+    """
+    def clippedFunc(x):
+        y = func(x)
+        if maximal_value is not None:
+            y = np.minimum(y, maximal_value)
+        return y
+
+    scale = np.abs(clippedFunc(np.array([zero_point], dtype=float)))[0]
+    t_test = np.cos(np.linspace(0, np.pi, 8 * degree + 1))
+
+    # bisect the intervals until the polynomials are accurate enough
+    intervals = [(min, max)]
+    breakpoints = []
+    polynomials = []
+    while len(intervals):
+        a, b = intervals.pop()
+        c = np.polynomial.chebyshev.chebinterpolate(lambda t: clippedFunc((a + b) / 2 + (b - a) / 2 * t), degree)
+        y = clippedFunc((a + b) / 2 + (b - a) / 2 * t_test)
+        error = np.abs(np.polynomial.chebyshev.chebval(t_test, c) - y)
+        if np.all(error <= tolerance * np.maximum(np.abs(y), scale)) or b - a < min_width:
+            breakpoints.append(a)
+            polynomials.append(c)
+        else:
+            # the lower half is popped first, so the intervals are collected in ascending order
+            intervals.append(((a + b) / 2, b))
+            intervals.append((a, (a + b) / 2))
+    breakpoints.append(max)
+    breakpoints = np.array(breakpoints)
+
+    # integrate each polynomial twice, the integration constants make the integrals continuous
+    coefficients = np.zeros((len(polynomials), 3, degree + 3))
+    int_y, int_int_y = 0, 0
+    for i, c in enumerate(polynomials):
+        half_width = (breakpoints[i + 1] - breakpoints[i]) / 2
+        coefficients[i, 2, :degree + 1] = c
+        coefficients[i, 1, :degree + 2] = np.polynomial.chebyshev.chebint(c, lbnd=-1, k=int_y, scl=half_width)
+        coefficients[i, 0, :] = np.polynomial.chebyshev.chebint(coefficients[i, 1, :degree + 2], lbnd=-1, k=int_int_y,
+                                                                 scl=half_width)
+        int_y = np.polynomial.chebyshev.chebval(1, coefficients[i, 1])
+        int_int_y = np.polynomial.chebyshev.chebval(1, coefficients[i, 0])
+
+    # both integrals vanish at the zero point
+    eps, eps_, eps__ = lookUpPiecewisePolynomial(np.array([float(zero_point)]), breakpoints, coefficients)
+    # eps'(x) - eps'(zero_point) and eps(x) - eps(zero_point) - eps'(zero_point) * (x - zero_point), with
+    # x = (b_i + b_i+1) / 2 + (b_i+1 - b_i) / 2 * t in each interval
+    coefficients[:, 1, 0] -= eps_[0]
+    coefficients[:, 0, 0] -= eps[0] + eps_[0] * ((breakpoints[:-1] + breakpoints[1:]) / 2 - zero_point)
+    coefficients[:, 0, 1] -= eps_[0] * (breakpoints[1:] - breakpoints[:-1]) / 2
+
+    return breakpoints, coefficients
+
+
+@njit()
+def lookUpPiecewisePolynomial(x, breakpoints, coefficients):
+    """
+    Evaluates the energy, its first and its second derivative given as piecewise Chebyshev polynomials (see
+    :py:func:`fitPiecewisePolynomial`) at x. Values outside of the breakpoints are clipped to the border.
+    """
+    eps = np.zeros(x.shape)
+    eps_ = np.zeros(x.shape)
+    eps__ = np.zeros(x.shape)
+    N = breakpoints.shape[0] - 1
+    xf = x.ravel()
+    for i in range(xf.shape[0]):
+        s = min(max(xf[i], breakpoints[0]), breakpoints[N])
+        k = min(np.searchsorted(breakpoints, s, side="right") - 1, N - 1)
+        # the position in the interval scaled to [-1, 1]
+        t = (2 * s - breakpoints[k] - breakpoints[k + 1]) / (breakpoints[k + 1] - breakpoints[k])
+        # evaluate the three polynomials with the Clenshaw recurrence
+        for j in range(3):
+            b1 = 0.0
+            b2 = 0.0
+            for n in range(coefficients.shape[2] - 1, 0, -1):
+                b1, b2 = coefficients[k, j, n] + 2 * t * b1 - b2, b1
+            value = coefficients[k, j, 0] + t * b1 - b2
+            if j == 0:
+                eps.flat[i] = value
+            elif j == 1:
+                eps_.flat[i] = value
+            else:
+                eps__.flat[i] = value
+    return eps, eps_, eps__
 
-        # if we are at the border of the discretisation, we stick to the end
-        max_index = li > ((max - min) / step) - 2
-        li[max_index] = int(((max - min) / step) - 2)
-        dli[max_index] = 0
 
-        # convert now to int after fixing the maximum
-        lii = li.astype(np.int64)
+def sampleAndIntegrateFunction(func, min, max, step, zero_point=0, maximal_value=10e10):
+    """
+    .. deprecated::
+        Use :py:func:`sampleAndIntegrateTables` and pass the tables to :py:func:`lookUpTables`.
 
-        # interpolate between the two discretisation steps
-        res0 = (1 - dli) * int_int_y[lii] + dli * int_int_y[lii + 1]
-        res1 = (1 - dli) * int_y[lii] + dli * int_y[lii + 1]
-        res2 = (1 - dli) * y[lii] + dli * y[lii + 1]
+    Samples and integrates func and returns a function that interpolates the tables at x.
+    """
+    warnings.warn("sampleAndIntegrateFunction is deprecated, use sampleAndIntegrateTables and lookUpTables",
+                  DeprecationWarning, stacklevel=2)
+    arguments = (float(min), float(max), float(step)) + sampleAndIntegrateTables(func, min, max, step, zero_point,
+                                                                                 maximal_value)
 
-        return res0.reshape(shape), res1.reshape(shape), res2.reshape(shape)
+    def lookUpY(x):
+        return lookUpTables(x, *arguments)
 
     return lookUpY
 
 
+@njit()
+def semiAffineFiberEpsilon(x, k1, ds0, s1, ds1, max, maximal_value):
+    """
+    The energy eps, its first derivative eps' and second derivative eps'' (the stiffness) of a semi-affine fiber in
+    closed form, see :py:class:`SemiAffineFiberMaterial`. A ds0 or ds1 of 0 disables the buckling or the stiffening.
+    As in the look up table, the stiffness is clipped at maximal_value and x is clipped at max.
+    """
+    eps = np.zeros(x.shape)
+    eps_ = np.zeros(x.shape)
+    eps__ = np.zeros(x.shape)
+
+    # where the stiffening reaches the maximal stiffness
+    if ds1 > 0:
+        s_max = s1 + ds1 * np.log(maximal_value / k1)
+        # eps(s_max) and eps'(s_max)
+        eps_at_max = k1 * (0.5 * s1 ** 2 + s1 * (s_max - s1) + ds1 ** 2 * (maximal_value / k1 - 1) - ds1 * (s_max - s1))
+        eps_prime_at_max = k1 * (s1 + ds1 * (maximal_value / k1 - 1))
+
+    xf = x.ravel()
+    for i in range(xf.shape[0]):
+        s = min(xf[i], max)
+        if ds0 > 0 and s < 0:
+            # buckling: eps'' = k1 * exp(s / ds0)
+            e = np.exp(s / ds0)
+            eps.flat[i] = k1 * ds0 ** 2 * (e - 1) - k1 * ds0 * s
+            eps_.flat[i] = k1 * ds0 * (e - 1)
+            eps__.flat[i] = k1 * e
+        elif ds1 > 0 and s > s_max:
+            # the clipped stiffness: eps'' = maximal_value
+            eps.flat[i] = eps_at_max + eps_prime_at_max * (s - s_max) + 0.5 * maximal_value * (s - s_max) ** 2
+            eps_.flat[i] = eps_prime_at_max + maximal_value * (s - s_max)
+            eps__.flat[i] = maximal_value
+        elif ds1 > 0 and s > s1:
+            # stiffening: eps'' = k1 * exp((s - s1) / ds1)
+            e = np.exp((s - s1) / ds1)
+            eps.flat[i] = k1 * (0.5 * s1 ** 2 + s1 * (s - s1) + ds1 ** 2 * (e - 1) - ds1 * (s - s1))
+            eps_.flat[i] = k1 * (s1 + ds1 * (e - 1))
+            eps__.flat[i] = k1 * e
+        else:
+            # the linear regime: eps'' = k1
+            eps.flat[i] = 0.5 * k1 * s ** 2
+            eps_.flat[i] = k1 * s
+            eps__.flat[i] = k1
+
+    return eps, eps_, eps__
+
+
 class Material:
     """
     The base class for all material models.
@@ -77,13 +251,61 @@ class Material:
     min = -1
     max = 4.0
     step = 0.000001
+    maximal_value = 10e10
+    cache_directory = None  # a directory to store the sampled tables, to reuse them for the same parameters
+    # how materials without a closed form are tabulated, "polynomial" (piecewise polynomials) or "sampled" (with step)
+    look_up_table = "polynomial"
+    look_up_tolerance = 1e-8  # the relative error of the stiffness for the piecewise polynomials
 
     def stiffness(self, s):
         # to be overloaded by a material implementation
         return s
 
+    def generate_look_up_function(self):
+        """
+        The compiled function to evaluate the energy and its first two derivatives and the additional arguments it
+        takes after the strain, function(x, *arguments) -> (eps, eps', eps''). Materials with the same function only
+        need to be compiled once.
+        """
+        # materials without a closed form are tabulated and integrated numerically
+        if self.look_up_table == "sampled":
+            arguments = (float(self.min), float(self.max), float(self.step)) + self.generate_tables()
+            return lookUpTables, arguments
+        return lookUpPiecewisePolynomial, fitPiecewisePolynomial(self.stiffness, self.min, self.max,
+                                                                 maximal_value=self.maximal_value,
+                                                                 tolerance=self.look_up_tolerance)
+
     def generate_look_up_table(self):
-        return sampleAndIntegrateFunction(self.stiffness, self.min, self.max, self.step)
+        function, arguments = self.generate_look_up_function()
+
+        def lookUpY(x):
+            return function(x, *arguments)
+
+        return lookUpY
+
+    def generate_tables(self):
+        """
+        Samples the stiffness and integrates it twice. If cache_directory is set, the tables are stored there as .npy
+        files, named after the material and its parameters, and are memory mapped when they are needed again.
+        """
+        if self.cache_directory is None:
+            return sampleAndIntegrateTables(self.stiffness, self.min, self.max, self.step,
+                                            maximal_value=self.maximal_value)
+
+        # the module makes the key unique for materials of the same class name, e.g. defined in different scripts
+        name = type(self).__module__ + "." + type(self).__qualname__
+        key = repr((name, sorted(self.parameters.items()), self.min, self.max, self.step, self.maximal_value))
+        filename = os.path.join(self.cache_directory, hashlib.sha1(key.encode()).hexdigest() + ".npy")
+        if not os.path.exists(filename):
+            tables = np.array(sampleAndIntegrateTables(self.stiffness, self.min, self.max, self.step,
+                                                       maximal_value=self.maximal_value))
+            os.makedirs(self.cache_directory, exist_ok=True)
+            # write to a temporary file first, so that parallel jobs never read an incomplete file
+            temporary_filename = filename[:-4] + "_%d.tmp.npy" % os.getpid()
+            np.save(temporary_filename, tables)
+            os.replace(temporary_filename, filename)
+        tables = np.load(filename, mmap_mode="r")
+        return np.asarray(tables[0]), np.asarray(tables[1]), np.asarray(tables[2])
 
     def __str__(self):
         return self.__class__.__name__+"("+", ".join(key+"="+str(value) for key, value in self.parameters.items())+")"
@@ -131,6 +353,12 @@ class SemiAffineFiberMaterial(Material):
 
         return stiff
 
+    def generate_look_up_function(self):
+        stiffening = self.s1 is not None and self.ds1 is not None
+        return semiAffineFiberEpsilon, (float(self.k1), float(self.ds0 or 0), float(self.s1 if stiffening else 0),
+                                        float(self.ds1 if stiffening else 0), float(self.max),
+                                        float(self.maximal_value))
+
     def energy(self, x0):
         # generate an empty target array
         x = x0.ravel()
@@ -188,6 +416,10 @@ class LinearMaterial(Material):
 
         return stiff
 
+    def generate_look_up_function(self):
+        # a semi-affine fiber without buckling and stiffening
+        return semiAffineFiberEpsilon, (float(self.k1), 0.0, 0.0, 0.0, float(self.max), float(self.maximal_value))
+
     def energy(self, x):
         # calculate the energy in the linear range
         return 0.5 * self.k1 * x**2
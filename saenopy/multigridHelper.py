@@ -1,4 +1,5 @@
 import numpy as np
+import scipy.sparse as ssp
 
 
 def makeBoxmeshCoords(dx, nx, rin, mulout):
@@ -32,8 +33,184 @@ def makeBoxmeshCoords(dx, nx, rin, mulout):
 
     return R
 
+
+def getBoxmeshProlongation1D(nx, grain):
+    """
+    The linear interpolation along one axis from the nodes of the grain 2*grain to the nodes of the grain.
+    """
+    # the node positions on the fine and the coarse grid
+    n_fine = len(range(0, nx, grain))
+    n_coarse = len(range(0, nx, 2 * grain))
+
+    rows = []
+    cols = []
+    weights = []
+    for i in range(n_fine):
+        # nodes that are also on the coarse grid are copied
+        if i % 2 == 0:
+            rows.append(i)
+            cols.append(i // 2)
+            weights.append(1.0)
+        # nodes in between two coarse nodes are interpolated
+        elif i // 2 + 1 < n_coarse:
+            rows.extend([i, i])
+            cols.extend([i // 2, i // 2 + 1])
+            weights.extend([0.5, 0.5])
+        # nodes behind the last coarse node take its value
+        else:
+            rows.append(i)
+            cols.append(i // 2)
+            weights.append(1.0)
+
+    return ssp.csr_matrix((weights, (rows, cols)), shape=(n_fine, n_coarse))
+
+
+def getBoxmeshProlongations(nx, min_nodes=3):
+    """
+    The trilinear prolongations between the grains 1, 2, 4, 8, ... of a box mesh with nx nodes per axis. Each
+    prolongation maps from the nodes of grain 2*g (x, y and z multiples of 2*g) to the nodes of grain g. The nodes of a
+    grain are numbered in the same order as in makeBoxmeshCoords, i = x + nx * y + nx * ny * z.
+
+    Parameters
+    ----------
+    nx : int
+        The number of nodes per axis of the box mesh.
+    min_nodes : int, optional
+        The number of nodes per axis below which no coarser grain is added.
+
+    Returns
+    -------
+    prolongations : list
+        The sparse prolongation matrices, from the finest to the coarsest grain.
+    """
+    prolongations = []
+    grain = 1
+    while len(range(0, nx, 2 * grain)) >= min_nodes:
+        P = getBoxmeshProlongation1D(nx, grain)
+        # x is the fastest running index, z the slowest
+        prolongations.append(ssp.kron(P, ssp.kron(P, P)).tocsr())
+        grain *= 2
+    return prolongations
+
+
 from numba import njit
 
+
+@njit()
+def getAggregates(indptr, indices, strong, free):
+    """
+    Greedy aggregation of the nodes of a graph along its strong connections (given in csr format). Fixed nodes are not
+    aggregated and get the aggregate -1.
+    """
+    N = indptr.shape[0] - 1
+    aggregates = np.full(N, -1, dtype=np.int64)
+    count = 0
+
+    # first pass: every node without an aggregated strong neighbour starts a new aggregate with its neighbours
+    for i in range(N):
+        if not free[i] or aggregates[i] >= 0:
+            continue
+        neighbours_free = True
+        for k in range(indptr[i], indptr[i + 1]):
+            if strong[k] and free[indices[k]] and aggregates[indices[k]] >= 0:
+                neighbours_free = False
+                break
+        if neighbours_free:
+            aggregates[i] = count
+            for k in range(indptr[i], indptr[i + 1]):
+                if strong[k] and free[indices[k]]:
+                    aggregates[indices[k]] = count
+            count += 1
+
+    # second pass: the remaining nodes join an aggregate of the first pass of a strong neighbour
+    first_pass = aggregates.copy()
+    for i in range(N):
+        if not free[i] or aggregates[i] >= 0:
+            continue
+        for k in range(indptr[i], indptr[i + 1]):
+            if strong[k] and first_pass[indices[k]] >= 0:
+                aggregates[i] = first_pass[indices[k]]
+                break
+
+    # third pass: nodes without any strong neighbour form their own aggregate
+    for i in range(N):
+        if free[i] and aggregates[i] < 0:
+            aggregates[i] = count
+            count += 1
+
+    return aggregates, count
+
+
+def getAggregationProlongations(A, free=None, max_nodes=100, theta=0.08, omega=4/3):
+    """
+    The prolongations of a smoothed aggregation algebraic multigrid for a matrix with 3 degrees of freedom per node.
+    The nodes are aggregated along strong connections of their 3x3 blocks and the aggregates carry the 3 translations as
+    coarse degrees of freedom. The tentative prolongation is then smoothed with one damped block-Jacobi step.
+
+    Parameters
+    ----------
+    A : sparse matrix
+        The matrix of the linear system, dimensions 3N x 3N.
+    free : ndarray, optional
+        A bool for each degree of freedom whether it is variable. Fixed nodes are not part of any aggregate.
+    max_nodes : int, optional
+        No further level is added once a level has less nodes.
+    theta : float, optional
+        The threshold for strong connections, |A_ij| >= theta * sqrt(|A_ii| |A_jj|) with the Frobenius norm of the
+        blocks.
+    omega : float, optional
+        The damping of the prolongation smoothing, relative to the spectral radius of D^-1 A.
+
+    Returns
+    -------
+    prolongations : list
+        The sparse prolongations, from the finest to the coarsest level.
+    """
+    from .conjugateGradient import BlockJacobiPreconditioner, getJacobiSpectralRadius
+
+    A = ssp.csr_matrix(A)
+    if free is None:
+        free_nodes = np.ones(A.shape[0] // 3, dtype=bool)
+    else:
+        free_nodes = np.asarray(free).reshape(-1, 3)[:, 0]
+
+    prolongations = []
+    while A.shape[0] // 3 > max_nodes:
+        N = A.shape[0] // 3
+
+        # the strength of the connections is the norm of the 3x3 blocks
+        B = A.tobsr(blocksize=(3, 3))
+        B.sort_indices()
+        rows = np.repeat(np.arange(N), np.diff(B.indptr))
+        norms = np.sqrt(np.sum(B.data ** 2, axis=(1, 2)))
+        diagonal = np.zeros(N)
+        diagonal[rows[B.indices == rows]] = norms[B.indices == rows]
+        strong = (norms >= theta * np.sqrt(diagonal[rows] * diagonal[B.indices])) & (B.indices != rows)
+
+        aggregates, count = getAggregates(B.indptr, B.indices, strong, free_nodes)
+        # stop if the aggregation does not at least halve the number of nodes anymore
+        if count == 0 or count > 0.5 * np.sum(free_nodes):
+            break
+
+        # the tentative prolongation copies the translation of each aggregate to its nodes
+        nodes = np.where(aggregates >= 0)[0]
+        sizes = np.bincount(aggregates[nodes], minlength=count)
+        T = ssp.csr_matrix((1 / np.sqrt(sizes[aggregates[nodes]]), (nodes, aggregates[nodes])), shape=(N, count))
+        T = ssp.kron(T, np.eye(3)).tocsr()
+
+        # smooth it with a block-Jacobi step, damped by the spectral radius of D^-1 A
+        smoother = BlockJacobiPreconditioner(A)
+        rho = getJacobiSpectralRadius(A, smoother)
+        DinvA = ssp.bsr_matrix((smoother.inverse, np.arange(N), np.arange(N + 1)), shape=A.shape) @ A
+        P = (T - (omega / rho) * (DinvA @ T)).tocsr()
+
+        prolongations.append(P)
+        A = (P.T @ A @ P).tocsr()
+        free_nodes = np.ones(count, dtype=bool)
+
+    return prolongations
+
+
 @njit()
 def makeBoxmeshTets(nx, grain=1):
     ny = nx